@@ -2,13 +2,194 @@
 app.py
 
 Flask application for the Rock-Paper-Scissors blockchain project UI.
-Provides a whiteboard page and a JSON endpoint for blockchains.
+Provides a whiteboard page, JSON endpoints for blockchains and standings,
+and a Server-Sent Events stream that pushes chain changes as they happen.
 """
+import json
+import logging
+import queue
+import threading
+import time
+
 import requests
-from flask import Flask, render_template, jsonify
+from flask import Flask, Response, render_template, jsonify
+
+from blockchain import Block
+from logconfig import setup_logging
+
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+TRACKER_URL = "http://localhost:9000"
+CACHE_TTL = 1.0       # seconds a tracker response is reused
+POLL_INTERVAL = 1.0   # seconds between tracker polls while dashboards are open
+
+# One pooled HTTP session for every request we make to the tracker
+session = requests.Session()
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def fetch_tracker(path):
+    """
+    GET a tracker endpoint, reusing the response for CACHE_TTL seconds.
+
+    Args:
+        path (str): Endpoint path, e.g. "/chains".
+
+    Returns:
+        object: Decoded JSON response.
+    """
+    with _cache_lock:
+        hit = _cache.get(path)
+        if hit is not None and time.monotonic() - hit[0] < CACHE_TTL:
+            return hit[1]
+    data = session.get(TRACKER_URL + path, timeout=5).json()
+    with _cache_lock:
+        _cache[path] = (time.monotonic(), data)
+    return data
+
+
+class ChainFeed:
+    """
+    Polls the tracker on behalf of every open dashboard and fans out diffs.
+
+    Each subscriber gets a full snapshot once, then only `blocks` events
+    (new blocks for one peer, possibly replacing a reorged suffix) and
+    `leaderboard` events when the standings change. Blocks are sent as
+    {"hash", "block"} entries so the page can key its DOM by block hash.
+
+    The tracker only keeps a window of each peer's newest blocks, so chains
+    are compared by block height rather than list position.
+    """
+    def __init__(self, max_backlog=256):
+        """
+        Create an idle feed; the poller starts with the first subscriber.
+
+        Args:
+            max_backlog (int): Events buffered per subscriber before it is dropped.
+        """
+        self.chains = {}   # peer_id -> (height of first block, raw block JSON strings), for diffing
+        self.entries = {}  # peer_id -> [{"hash", "block"}], what subscribers see
+        self.leaderboard = []
+        self.subscribers = set()
+        self.max_backlog = max_backlog
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self):
+        """
+        Register a new subscriber.
+
+        Returns:
+            tuple: (queue of events, snapshot dict taken atomically with it).
+        """
+        q = queue.Queue(maxsize=self.max_backlog)
+        with self.lock:
+            self.subscribers.add(q)
+            snapshot = {"chains": dict(self.entries), "leaderboard": self.leaderboard}
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.poll_loop, daemon=True)
+                self.thread.start()
+        return q, snapshot
+
+    def unsubscribe(self, q):
+        """
+        Remove a subscriber's queue.
+        """
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, kind, data):
+        """
+        Send an event to every subscriber, dropping those that fall behind.
+
+        A dropped subscriber's stream is closed, and the browser's
+        EventSource reconnects to receive a fresh snapshot.
+        """
+        for q in list(self.subscribers):
+            try:
+                q.put_nowait((kind, data))
+            except queue.Full:
+                q.dropped = True
+                self.subscribers.discard(q)
+
+    @staticmethod
+    def diff(old, old_start, new, new_start):
+        """
+        Find where two windows of one peer's chain diverge.
+
+        Blocks link to their parent's hash, so once two heights hold the
+        same block everything below them matches too.
+
+        Args:
+            old (list): Previous window of raw blocks, starting at height old_start.
+            new (list): Current window of raw blocks, starting at height new_start.
+
+        Returns:
+            int: Height of the first block in `new` that `old` does not hold.
+        """
+        if new_start < old_start:
+            return new_start
+        i = min(old_start + len(old), new_start + len(new))
+        while i > new_start and old[i - 1 - old_start] != new[i - 1 - new_start]:
+            i -= 1
+        return max(i, new_start)
+
+    @staticmethod
+    def entry(block_json):
+        """
+        Turn a raw block JSON string into a {"hash", "block"} entry.
+        """
+        return {"hash": Block.from_json(block_json).header_hash(),
+                "block": json.loads(block_json)}
+
+    def poll_once(self):
+        """
+        Fetch chains and standings once and publish whatever changed.
+        """
+        chains = fetch_tracker("/chains")
+        leaderboard = fetch_tracker("/leaderboard")
+        with self.lock:
+            for peer_id, chain in chains.items():
+                if not chain:
+                    continue
+                old_start, old = self.chains.get(peer_id, (0, []))
+                start = Block.from_json(chain[0]).index
+                base = self.diff(old, old_start, chain, start)
+                if start == old_start and base == start + len(chain) == old_start + len(old):
+                    continue
+                added = [self.entry(js) for js in chain[base - start:]]
+                self.chains[peer_id] = (start, chain)
+                self.entries[peer_id] = [e for e in self.entries.get(peer_id, [])
+                                         if start <= e["block"]["header"]["index"] < base] + added
+                self.publish("blocks", {"peer": peer_id, "start": start, "base": base, "blocks": added})
+            for peer_id in list(self.chains):
+                if peer_id not in chains:
+                    del self.chains[peer_id]
+                    del self.entries[peer_id]
+                    self.publish("blocks", {"peer": peer_id, "base": 0, "blocks": [], "removed": True})
+            if leaderboard != self.leaderboard:
+                self.leaderboard = leaderboard
+                self.publish("leaderboard", leaderboard)
+
+    def poll_loop(self):
+        """
+        Poll the tracker every POLL_INTERVAL seconds for as long as the app runs.
+        """
+        while True:
+            if self.subscribers:
+                try:
+                    self.poll_once()
+                except requests.RequestException as e:
+                    log.warning("Tracker poll failed: %s", e)
+            time.sleep(POLL_INTERVAL)
+
+
+feed = ChainFeed()
+
+
 @app.route('/')
 def whiteboard():
     """
@@ -22,9 +203,44 @@ def get_chains():
     """
     Fetch the current chains from the tracker and return them as JSON.
     """
-    chains = requests.get("http://localhost:9000/chains").json()
-    return jsonify(chains)
+    return jsonify(fetch_tracker("/chains"))
+
+
+@app.route('/leaderboard')
+def get_leaderboard():
+    """
+    Fetch the current win/loss/tie standings from the tracker.
+    """
+    return jsonify(fetch_tracker("/leaderboard"))
+
+
+@app.route('/stream')
+def stream():
+    """
+    Server-Sent Events stream of chain changes.
+
+    Sends a `snapshot` event first, then `blocks` and `leaderboard` events as
+    the tracker's view changes.
+    """
+    q, snapshot = feed.subscribe()
+
+    def events():
+        try:
+            yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            while not getattr(q, "dropped", False):
+                try:
+                    kind, data = q.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            feed.unsubscribe(q)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
 
 
 if __name__ == "__main__":
-    app.run(port=8000)
+    setup_logging()
+    app.run(port=8000, threaded=True)
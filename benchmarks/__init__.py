@@ -0,0 +1,70 @@
+"""
+benchmarks
+
+Micro-benchmarks for the RPS blockchain's hot paths: hashing, mining,
+block serialization and chain validation.
+
+Run from the project root:
+
+    python -m benchmarks                     # full run, table on stdout
+    python -m benchmarks --quick             # fewer/smaller cases
+    python -m benchmarks --output out.json   # also write machine-readable results
+    python -m benchmarks --compare out.json  # show speedup vs an earlier run
+"""
+
+import contextlib
+import statistics
+import timeit
+
+import utils
+
+
+def measure(fn, repeat=5):
+    """
+    Time a zero-argument callable.
+
+    The loop count is calibrated (as `python -m timeit` does) so each
+    repetition takes at least 0.2 seconds, then per-call statistics are
+    reported across `repeat` repetitions.
+
+    Args:
+        fn (callable): Operation to time.
+        repeat (int): Number of timed repetitions.
+
+    Returns:
+        dict: `mean_s`, `min_s`, `stdev_s` per call, `ops_per_sec` and `loops`.
+    """
+    timer = timeit.Timer(fn)
+    loops, _ = timer.autorange()
+    per_call = [t / loops for t in timer.repeat(repeat=repeat, number=loops)]
+    mean = statistics.mean(per_call)
+    return {
+        "mean_s": mean,
+        "min_s": min(per_call),
+        "stdev_s": statistics.stdev(per_call) if len(per_call) > 1 else 0.0,
+        "ops_per_sec": 1.0 / mean if mean else float("inf"),
+        "loops": loops,
+    }
+
+
+@contextlib.contextmanager
+def difficulty(target):
+    """
+    Temporarily change the proof-of-work target used by utils.pow_ok().
+
+    Args:
+        target (str): Required hex prefix, e.g. "00". "" accepts any hash.
+    """
+    old = utils.DIFFICULTY
+    utils.DIFFICULTY = target
+    try:
+        yield
+    finally:
+        utils.DIFFICULTY = old
+
+
+def result(name, params, stats, **extra):
+    """
+    Build one machine-readable result row.
+    """
+    return {"name": name, "params": params, **stats, **extra}
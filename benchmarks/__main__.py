@@ -0,0 +1,103 @@
+"""
+Command-line entry point: python -m benchmarks [--quick] [--only NAME]
+[--output FILE] [--compare FILE]
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+
+from benchmarks import bench_block, bench_chain, bench_hashing
+
+SUITES = {
+    "hashing": bench_hashing,
+    "block": bench_block,
+    "chain": bench_chain,
+}
+
+
+def git_commit():
+    """
+    Return the current git commit hash, or None outside a checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def key(row):
+    """
+    Identify a result row across runs by benchmark name and parameters.
+    """
+    return row["name"], json.dumps(row["params"], sort_keys=True)
+
+
+def rate(row):
+    """
+    Return the throughput figure used to compare a row between runs.
+    """
+    return row.get("hashes_per_sec", row.get("ops_per_sec"))
+
+
+def print_table(rows, baseline=None):
+    """
+    Print results as an aligned table, with speedups if a baseline is given.
+    """
+    before = {key(r): r for r in baseline["results"]} if baseline else {}
+    for row in rows:
+        params = ", ".join(f"{k}={v}" for k, v in row["params"].items())
+        unit = "hash/s" if "hashes_per_sec" in row else "op/s"
+        line = f"{row['name']:<20} {params:<34} {rate(row):>14,.1f} {unit}"
+        old = before.get(key(row))
+        if old is not None and rate(old):
+            line += f"   x{rate(row) / rate(old):.2f} vs baseline"
+        print(line)
+
+
+def main(argv=None):
+    """
+    Run the selected suites and report the results.
+    """
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="RPS blockchain micro-benchmarks")
+    parser.add_argument("--quick", action="store_true", help="fewer and smaller cases")
+    parser.add_argument("--only", choices=sorted(SUITES), action="append",
+                        help="run only this suite (repeatable)")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    rows = []
+    for name in args.only or SUITES:
+        print(f"# {name}", file=sys.stderr)
+        rows += SUITES[name].run(quick=args.quick)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "quick": args.quick,
+        },
+        "results": rows,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(rows, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
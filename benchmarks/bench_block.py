@@ -0,0 +1,63 @@
+"""
+bench_block.py
+
+Benchmarks for Block: proof-of-work hash rate, header hashing and
+JSON round-trips.
+"""
+
+import time
+
+from blockchain import Block
+from benchmarks import measure, result, difficulty
+from benchmarks.bench_chain import match_transactions
+
+
+def mine_rate(target, blocks):
+    """
+    Mine `blocks` distinct blocks at a difficulty and report the hash rate.
+
+    Args:
+        target (str): Proof-of-work prefix.
+        blocks (int): Number of blocks to mine.
+
+    Returns:
+        dict: Hashes tried, elapsed seconds, hashes/sec and seconds per block.
+    """
+    hashes = 0
+    with difficulty(target):
+        start = time.perf_counter()
+        for i in range(blocks):
+            blk = Block(1, "0" * 64, match_transactions(f"mine_{i}", 1, 2))
+            hashes += blk.mine()
+        elapsed = time.perf_counter() - start
+    return {"hashes": hashes, "elapsed_s": elapsed,
+            "hashes_per_sec": hashes / elapsed, "seconds_per_block": elapsed / blocks}
+
+
+def run(quick=False):
+    """
+    Measure mining, header hashing and serialization.
+
+    Returns:
+        list: Result rows.
+    """
+    repeat = 3 if quick else 5
+    rows = []
+
+    targets = ("0", "00", "000") if quick else ("0", "00", "000", "0000")
+    for target in targets:
+        blocks = 4 if quick else 16
+        rows.append(result("Block.mine", {"difficulty": len(target), "blocks": blocks},
+                           mine_rate(target, blocks)))
+
+    for matches in (1, 10, 100) if not quick else (1, 10):
+        txs = []
+        for m in range(matches):
+            txs += match_transactions(f"match_{m}", 1, 2)
+        blk = Block(1, "0" * 64, txs, nonce=12345)
+        js = blk.to_json()
+        params = {"matches": matches, "bytes": len(js)}
+        rows.append(result("Block.header_hash", params, measure(blk.header_hash, repeat)))
+        rows.append(result("Block.to_json", params, measure(blk.to_json, repeat)))
+        rows.append(result("Block.from_json", params, measure(lambda: Block.from_json(js), repeat)))
+    return rows
@@ -0,0 +1,81 @@
+"""
+bench_chain.py
+
+Benchmarks for Blockchain._valid and Blockchain.add across chain lengths
+and block sizes.
+"""
+
+import secrets
+
+from blockchain import Block, Blockchain
+from utils import sha256
+from benchmarks import measure, result, difficulty
+
+
+def match_transactions(match_id, peer_a, peer_b):
+    """
+    Build the five transactions of one valid match (2 commits, 2 reveals, 1 result).
+    """
+    txs = []
+    reveals = []
+    for peer, move in ((peer_a, "rock"), (peer_b, "scissors")):
+        key = secrets.token_hex(4)
+        txs.append({"type": "COMMIT", "match_id": match_id, "peer": peer,
+                    "hash": sha256((move + key).encode())})
+        reveals.append({"type": "REVEAL", "match_id": match_id, "peer": peer,
+                        "move": move, "key": key})
+    txs += reveals
+    txs.append({"type": "RESULT", "match_id": match_id, "winner": peer_a, "tie": False})
+    return txs
+
+
+def build_chain(length, matches_per_block):
+    """
+    Build a chain of `length` blocks on top of genesis with PoW disabled.
+
+    Must be called inside `difficulty("")`.
+    """
+    bc = Blockchain()
+    for i in range(length):
+        txs = []
+        for m in range(matches_per_block):
+            txs += match_transactions(f"match_{i}_{m}", 1, 2)
+        bc.chain.append(Block(bc.height() + 1, bc.tip(), txs))
+    return bc
+
+
+def run(quick=False):
+    """
+    Measure block validation and chain extension.
+
+    Returns:
+        list: Result rows.
+    """
+    repeat = 3 if quick else 5
+    rows = []
+    with difficulty(""):
+        for matches in (1, 10, 100) if not quick else (1, 10):
+            bc = Blockchain()
+            blk = build_chain(1, matches).chain[-1]
+            prev = bc.chain[-1]
+            assert bc._valid(blk, prev)
+            rows.append(result("Blockchain._valid", {"matches": matches},
+                               measure(lambda: bc._valid(blk, prev), repeat)))
+
+        for length in (10, 1000) if not quick else (10,):
+            for matches in (1, 10):
+                bc = build_chain(length, 1)
+                txs = []
+                for m in range(matches):
+                    txs += match_transactions(f"new_{m}", 1, 2)
+                blk = Block(bc.height() + 1, bc.tip(), txs)
+                assert bc._valid(blk, bc.chain[-1])
+
+                def add_and_undo():
+                    bc.add(blk)
+                    bc.chain.pop()
+                    bc._apply(blk, -1)
+
+                rows.append(result("Blockchain.add", {"chain_length": length, "matches": matches},
+                                   measure(add_and_undo, repeat)))
+    return rows
@@ -0,0 +1,41 @@
+"""
+bench_hashing.py
+
+Benchmarks for utils.sha256 and utils.hash_json.
+"""
+
+import json
+
+from utils import sha256, hash_json
+from benchmarks import measure, result
+
+
+def sample_transactions(n):
+    """
+    Build n transaction dicts shaped like real COMMIT messages.
+    """
+    return [{"type": "COMMIT", "match_id": f"match_{i}", "peer": i % 7 + 1,
+             "hash": sha256(str(i).encode())} for i in range(n)]
+
+
+def run(quick=False):
+    """
+    Measure raw and JSON hashing at a few payload sizes.
+
+    Returns:
+        list: Result rows.
+    """
+    repeat = 3 if quick else 5
+    rows = []
+    for size in (64, 1024, 16384) if not quick else (64, 1024):
+        data = b"x" * size
+        stats = measure(lambda: sha256(data), repeat)
+        rows.append(result("utils.sha256", {"bytes": size}, stats,
+                           mb_per_sec=stats["ops_per_sec"] * size / 1e6))
+
+    for n in (1, 10, 100) if not quick else (1, 10):
+        obj = {"transactions": sample_transactions(n)}
+        size = len(json.dumps(obj, sort_keys=True))
+        stats = measure(lambda: hash_json(obj), repeat)
+        rows.append(result("utils.hash_json", {"transactions": n, "bytes": size}, stats))
+    return rows
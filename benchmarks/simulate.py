@@ -0,0 +1,228 @@
+"""
+simulate.py
+
+In-process load test: boots a Tracker (or several tracker shards) and N
+Peers on loopback, lets them play for a while, then reports throughput,
+block propagation latency, fork rate, dropped blocks and how long the peers
+take to converge.
+
+    python -m benchmarks.simulate --peers 8 --difficulty 3 --match-interval 1 --duration 30
+"""
+
+import argparse
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import tracker as tracker_module
+from tracker import Tracker
+from peer import Peer
+from shard import Broker
+from benchmarks import difficulty
+from logconfig import setup_logging
+
+
+def free_port():
+    """
+    Return a TCP port on loopback that is currently free.
+    """
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of numbers, or None if it is empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def _ms(seconds):
+    """
+    Convert seconds to rounded milliseconds, passing None through.
+    """
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class BlockRecorder:
+    """
+    Wraps each peer's Blockchain.add to record when every block reaches every peer.
+    """
+    def __init__(self):
+        """
+        Create an empty recorder.
+        """
+        self.lock = threading.Lock()
+        self.first_seen = {}  # block hash -> (time, index)
+        self.arrivals = {}    # block hash -> {peer: time}
+        self.reorgs = 0
+        self.rejected = 0
+
+    def attach(self, peer):
+        """
+        Instrument one peer's blockchain.
+        """
+        chain = peer.blockchain
+        original_add = chain.add
+
+        def add(blk):
+            height = chain.height()
+            changed = original_add(blk)
+            now = time.perf_counter()
+            h = blk.header_hash()
+            with self.lock:
+                if not changed:
+                    self.rejected += 1
+                    return changed
+                if chain.height() == height:
+                    self.reorgs += 1
+                self.first_seen.setdefault(h, (now, blk.index))
+                self.arrivals.setdefault(h, {}).setdefault(peer, now)
+            return changed
+
+        chain.add = add
+
+
+def run(peers=4, target="000", match_interval=1.0, duration=20.0, settle=15.0, max_matches=1, shards=1):
+    """
+    Run one simulation and return its report.
+
+    Args:
+        peers (int): Number of peers to start.
+        target (str): Proof-of-work prefix used for every block.
+        match_interval (float): Seconds between matchmaking rounds.
+        duration (float): Seconds of play before matchmaking is stopped.
+        settle (float): Max seconds to wait for in-flight matches and convergence.
+        max_matches (int): Matches each peer may play at the same time.
+        shards (int): Tracker shards sharing one broker; peers join them round-robin.
+
+    Returns:
+        dict: Simulation metrics.
+    """
+    broker_dir = tempfile.TemporaryDirectory() if shards > 1 else None
+    with difficulty(target):
+        trackers = []
+        for _ in range(shards):
+            broker = Broker(os.path.join(broker_dir.name, "broker.db")) if broker_dir else None
+            trackers.append(Tracker(port=free_port(), match_interval=match_interval,
+                                    max_matches_per_peer=max_matches, broker=broker))
+            threading.Thread(target=trackers[-1].start, daemon=True).start()
+        tracker_module.tracker = trackers[0]
+        time.sleep(0.5 if broker_dir else 0.2)  # give shards time to see each other
+
+        recorder = BlockRecorder()
+        nodes = []
+        for i in range(peers):
+            # keep whole chains in memory so the report can inspect them
+            peer = Peer(tracker_port=trackers[i % shards].port, finality_depth=None)
+            recorder.attach(peer)
+            peer.connect_to_tracker()
+            nodes.append(peer)
+
+        start = time.perf_counter()
+        time.sleep(duration)
+        for tracker in trackers:
+            tracker.call_soon(setattr, tracker, "matchmaking_enabled", False)
+        stopped = time.perf_counter()
+
+        def played():
+            return {r["match_id"] for tracker in trackers
+                    for r in tracker.match_log.page(0, tracker.match_log.next_seq)["records"]}
+
+        # let in-flight matches finish and get mined, then wait for every tip to agree
+        converged_at = None
+        deadline = stopped + settle
+        while time.perf_counter() < deadline:
+            if not any(tracker.active_matches for tracker in trackers) \
+                    and len({p.blockchain.tip() for p in nodes}) == 1 \
+                    and played() <= nodes[0].blockchain.included:
+                converged_at = time.perf_counter()
+                break
+            time.sleep(0.05)
+        for tracker in trackers:
+            tracker.stop()
+
+    matches = played()
+
+    # reference chain: the one most peers ended up with
+    tips = {}
+    for p in nodes:
+        tips.setdefault(p.blockchain.tip(), []).append(p)
+    final = max(tips.values(), key=len)[0].blockchain.chain
+    final_hashes = {blk.header_hash() for blk in final}
+    on_chain = {tx["match_id"] for blk in final for tx in blk.transactions if tx.get("type") == "RESULT"}
+
+    latencies = []
+    by_height = {}
+    for h, (seen, index) in recorder.first_seen.items():
+        by_height.setdefault(index, set()).add(h)
+        if h in final_hashes:
+            latencies += [t - seen for t in recorder.arrivals[h].values()]
+    forks = sum(1 for hashes in by_height.values() if len(hashes) > 1)
+    height = len(final) - 1
+
+    return {
+        "peers": peers,
+        "shards": shards,
+        "difficulty": len(target),
+        "match_interval_s": match_interval,
+        "max_matches_per_peer": max_matches,
+        "duration_s": stopped - start,
+        "matches": len(matches),
+        "matches_per_sec": len(matches) / (stopped - start),
+        "height": height,
+        "matches_on_chain": len(on_chain & matches),
+        "propagation_ms": {
+            "p50": _ms(percentile(latencies, 50)),
+            "p90": _ms(percentile(latencies, 90)),
+            "p99": _ms(percentile(latencies, 99)),
+            "max": _ms(max(latencies) if latencies else None),
+        },
+        "fork_rate": forks / height if height else 0.0,
+        "reorgs": recorder.reorgs,
+        "rejected_proposals": recorder.rejected,
+        "dropped_blocks": len(set(recorder.first_seen) - final_hashes),
+        "converged": converged_at is not None,
+        "convergence_s": converged_at - stopped if converged_at is not None else None,
+        "distinct_tips": len(tips),
+    }
+
+
+def main(argv=None):
+    """
+    Parse arguments, run the simulation and print the report as JSON.
+    """
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.simulate",
+                                     description="In-process multi-peer load test")
+    parser.add_argument("--peers", type=int, default=4)
+    parser.add_argument("--difficulty", type=int, default=3, help="leading zero hex digits")
+    parser.add_argument("--match-interval", type=float, default=1.0, help="seconds between matchmaking rounds")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of play")
+    parser.add_argument("--max-matches", type=int, default=1, help="matches each peer may play at once")
+    parser.add_argument("--shards", type=int, default=1, help="tracker shards sharing one broker")
+    parser.add_argument("--settle", type=float, default=15.0, help="max seconds to wait for convergence")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--verbose", action="store_true", help="show peer/tracker INFO logs")
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        setup_logging("INFO")
+    report = run(args.peers, "0" * args.difficulty, args.match_interval,
+                 args.duration, args.settle, args.max_matches, args.shards)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,16 @@ Core blockchain logic for the Rock-Paper-Scissors application.
 Defines Block and Blockchain classes with PoW mining, validation, and chain reorganization.
 """
 
+import array
 import json
+import logging
+import threading
 import time
 
 from utils import sha256, hash_json, pow_ok
+from metrics import Registry
+
+log = logging.getLogger(__name__)
 
 class Block:
     """
@@ -50,12 +56,24 @@ class Block:
         """
         return sha256(json.dumps(self.header(), sort_keys=True).encode())
     
-    def mine(self):
+    def mine(self, max_tries=None):
         """
         Increment nonce until proof-of-work condition is met.
+
+        Args:
+            max_tries (int, optional): Give up after this many hashes, leaving
+                the nonce at the next untried value so mining can resume.
+
+        Returns:
+            int: Number of header hashes computed.
         """
+        hashes = 1
         while not pow_ok(self.header_hash()):
             self.nonce += 1
+            if max_tries is not None and hashes >= max_tries:
+                return hashes
+            hashes += 1
+        return hashes
     
     def to_json(self):
         """
@@ -77,10 +95,19 @@ class Blockchain:
     """
     Manages the chain of blocks and handles validation and reorganization.
     """
-    def __init__(self):
+    def __init__(self, metrics=None, finality_depth=None, store=None):
         """
         Create a new Blockchain with a mined genesis block.
+
+        Args:
+            metrics (Registry, optional): Registry to record chain metrics in.
+            finality_depth (int, optional): Blocks kept in memory below the tip
+                before older ones are folded into a snapshot and evicted.
+                None keeps every block.
+            store (BlockStore, optional): Where evicted blocks are kept on disk.
         """
+        if finality_depth is not None and finality_depth < 2:
+            raise ValueError("finality_depth must be at least 2 to resolve depth-1 forks")
         # starting block
         genesis = Block(
           index=0,
@@ -90,7 +117,23 @@ class Blockchain:
         )
         # mine it so the same difficulty rule applies
         genesis.mine()
+        # Blocks held in memory; chain[0] is genesis until the first eviction
         self.chain = [genesis]
+        # peer_id -> {"wins", "losses", "ties"}, kept in step with the whole chain
+        self.ledger = {}
+        self.included = set()  # match ids with a RESULT in self.chain
+        self.finality_depth = finality_depth
+        self.store = store
+        # {"height", "tip", "ledger"} as of the newest evicted block
+        self.snapshot = None
+
+        self.metrics = metrics if metrics is not None else Registry()
+        self._appended = self.metrics.counter("rps_blocks_appended_total", "Blocks appended to the local chain")
+        self._rejected = self.metrics.counter("rps_blocks_rejected_total", "Blocks that could not be added")
+        self._reorgs = self.metrics.counter("rps_reorgs_total", "Chain reorganizations")
+        self._reorg_depth = self.metrics.histogram("rps_reorg_depth", "Blocks replaced per reorganization",
+                                                   buckets=(1, 2, 3, 5, 10, 50, 100))
+        self._pruned = self.metrics.counter("rps_blocks_pruned_total", "Finalized blocks evicted from memory")
 
     @staticmethod
     def _winner(move_a, move_b):
@@ -105,6 +148,49 @@ class Blockchain:
         beats = {"rock":"scissors", "scissors":"paper", "paper":"rock"}
         return 1 if beats[move_a] == move_b else 2
 
+    @staticmethod
+    def _match_results(blk):
+        """
+        Yield the outcome of every completed match recorded in a block.
+
+        Yields:
+            tuple: (match_id, players, winner, tie) where players is the list of
+            peer ids that revealed a move and winner is 0 on a tie.
+        """
+        players = {}
+        results = {}
+        for tx in blk.transactions:
+            if tx.get("type") == "REVEAL":
+                players.setdefault(tx["match_id"], []).append(tx["peer"])
+            elif tx.get("type") == "RESULT":
+                results[tx["match_id"]] = tx
+        for match_id, result in results.items():
+            yield match_id, players.get(match_id, []), result["winner"], result["tie"]
+
+    def _apply(self, blk, sign, ledger=None):
+        """
+        Add (sign=1) or revert (sign=-1) a block's match results in the ledger.
+
+        Args:
+            ledger (dict, optional): Ledger to update instead of self.ledger;
+                self.included is left alone then.
+        """
+        target = self.ledger if ledger is None else ledger
+        for match_id, players, winner, tie in self._match_results(blk):
+            if ledger is None:
+                if sign > 0:
+                    self.included.add(match_id)
+                else:
+                    self.included.discard(match_id)
+            for peer in players:
+                entry = target.setdefault(peer, {"wins": 0, "losses": 0, "ties": 0})
+                if tie:
+                    entry["ties"] += sign
+                elif peer == winner:
+                    entry["wins"] += sign
+                else:
+                    entry["losses"] += sign
+
     def _valid(self, blk, prev):
         """
         Validate a block against its previous block and game rules.
@@ -113,12 +199,28 @@ class Blockchain:
             blk (Block): Block to validate.
             prev (Block): Previous block in the chain.
 
+        Returns:
+            bool: True if valid, False otherwise.
+        """
+        return self.valid_after(blk, prev.index, prev.header_hash())
+
+    def valid_after(self, blk, prev_index, prev_hash):
+        """
+        Validate a block against the height and hash of its parent and game rules.
+
+        Lets blocks be checked on top of a snapshot, whose tip block we may not hold.
+
+        Args:
+            blk (Block): Block to validate.
+            prev_index (int): Height of the parent block.
+            prev_hash (str): Header hash of the parent block.
+
         Returns:
             bool: True if valid, False otherwise.
         """
         # 1. chain linkage & PoW
-        if blk.index != prev.index + 1:        return False
-        if blk.prev  != prev.header_hash():    return False
+        if blk.index != prev_index + 1:        return False
+        if blk.prev  != prev_hash:             return False
         if not pow_ok(blk.header_hash()):      return False
 
         # Skip validation for genesis block
@@ -185,40 +287,163 @@ class Blockchain:
             bool: True if chain was modified, False otherwise.
         """
         tip = self.chain[-1]
-        prev = blk.prev[:12]
-        tip_hash = tip.header_hash()[:12]
-        second_hash = (self.chain[-2].header_hash()[:12]
-                       if len(self.chain) >= 2 else None)
-        print(f"[DEBUG add] blk.index={blk.index}, blk.prev={prev}, tip={tip_hash}, parent={second_hash}")
+        tip_hash = tip.header_hash()
+        if log.isEnabledFor(logging.DEBUG):
+            second_hash = (self.chain[-2].header_hash()[:12]
+                           if len(self.chain) >= 2 else None)
+            log.debug("add blk.index=%s blk.prev=%s tip=%s parent=%s",
+                      blk.index, blk.prev[:12], tip_hash[:12], second_hash)
 
         # case 1: normal append
-        if blk.prev == tip.header_hash():
-            print("  trying case1 append")
+        if blk.prev == tip_hash:
+            log.debug("  trying case1 append")
             if self._valid(blk, tip):
-                print("  -> case1 valid, appending")
+                log.debug("  -> case1 valid, appending")
                 self.chain.append(blk)
+                self._apply(blk, 1)
+                self._appended.inc()
+                self._prune()
                 return True
-            print("  -> case1 invalid")
+            log.debug("  -> case1 invalid")
+            self._rejected.inc()
             return False
 
         # case 2: fork of depth-1
         if len(self.chain) >= 2 and blk.prev == self.chain[-2].header_hash():
             # block’s prev points to the second‐to‐last block in your chain (i.e. it “skipped” the current tip).
-            print("  trying case 2: fork of depth 1 detected")
+            log.debug("  trying case 2: fork of depth 1 detected")
             if not self._valid(blk, self.chain[-2]):
-                print("  -> case2 invalid")
+                log.debug("  -> case2 invalid")
+                self._rejected.inc()
                 return False
-            if blk.header_hash() < tip.header_hash():
-                print("  -> case2 valid & better PoW, reorganize")
+            if blk.header_hash() < tip_hash:
+                log.debug("  -> case2 valid & better PoW, reorganize")
+                self._apply(tip, -1)
                 self.chain[-1] = blk
+                self._apply(blk, 1)
+                self._reorgs.inc()
+                self._reorg_depth.observe(1)
                 return True
             else:
-                print("  -> case2 valid but worse PoW, keep old tip")
+                log.debug("  -> case2 valid but worse PoW, keep old tip")
+            self._rejected.inc()
             return False
-        print("  -> no matching case")
+        log.debug("  -> no matching case")
 
+        self._rejected.inc()
         return False
 
+    def replace(self, chain, snapshot=None):
+        """
+        Adopt another chain (e.g. from a CHAIN_RESPONSE).
+
+        The blocks must start at genesis, right after a block we still hold,
+        right after our own snapshot, or right after `snapshot`, and every
+        block is validated on top of that parent before anything changes.
+
+        Args:
+            chain (list): Consecutive blocks.
+            snapshot (dict, optional): The sender's snapshot, for a chain
+                whose first block lies above everything we know.
+
+        Returns:
+            bool: True if the chain was adopted.
+        """
+        start = chain[0].index
+        parent = self.block_at(start - 1) if start > 0 else None
+        ours = self.snapshot
+
+        if start == 0:
+            kept, base = [], {}
+        elif parent is not None and start - 1 >= self.chain[0].index and parent.header_hash() == chain[0].prev:
+            kept, base = self.chain[:start - self.chain[0].index], None
+        elif ours is not None and ours["height"] == start - 1 and ours["tip"] == chain[0].prev:
+            kept, base = [], ours["ledger"]
+        elif snapshot is not None and snapshot["height"] == start - 1 and snapshot["tip"] == chain[0].prev:
+            kept, base = [], snapshot["ledger"]
+            ours = snapshot
+        else:
+            return False
+
+        # each branch above checked chain[0].prev against the parent's hash
+        prev_index, prev_hash = start - 1, chain[0].prev
+        for blk in chain:
+            if not self.valid_after(blk, prev_index, prev_hash):
+                log.debug("  -> replacement block #%s invalid", blk.index)
+                self._rejected.inc()
+                return False
+            prev_index, prev_hash = blk.index, blk.header_hash()
+
+        # count how many of our blocks the new chain throws away
+        new_hashes = {blk.header_hash() for blk in chain}
+        thrown = sum(1 for blk in self.chain if blk.index >= start and blk.header_hash() not in new_hashes)
+        if thrown:
+            self._reorgs.inc()
+            self._reorg_depth.observe(thrown)
+
+        if base is None:
+            # fork inside our window: unwind our suffix, then play theirs
+            for blk in reversed(self.chain[len(kept):]):
+                self._apply(blk, -1)
+        else:
+            # start over from genesis or a snapshot; JSON turned peer ids into strings
+            self.ledger = {int(peer): dict(entry) for peer, entry in base.items()}
+            self.included = set()
+            self.snapshot = None if start == 0 else \
+                dict(ours, ledger={int(p): dict(e) for p, e in ours["ledger"].items()})
+        self.chain = kept + list(chain)
+        for blk in chain:
+            self._apply(blk, 1)
+        self._prune()
+        return True
+
+    def _prune(self):
+        """
+        Evict blocks buried deeper than finality_depth, folding them into the snapshot.
+
+        Runs once the in-memory window reaches twice finality_depth, so a new
+        snapshot is taken about every finality_depth blocks.
+        """
+        if self.finality_depth is None or len(self.chain) < 2 * self.finality_depth:
+            return
+        cut = len(self.chain) - self.finality_depth
+        evicted = self.chain[:cut]
+        del self.chain[:cut]
+
+        ledger = {peer: dict(entry) for peer, entry in self.snapshot["ledger"].items()} if self.snapshot else {}
+        for blk in evicted:
+            self._apply(blk, 1, ledger)
+            for match_id, *_ in self._match_results(blk):
+                self.included.discard(match_id)
+            if self.store is not None:
+                self.store.put(blk)
+        self.snapshot = {"height": evicted[-1].index, "tip": evicted[-1].header_hash(), "ledger": ledger}
+        self._pruned.inc(len(evicted))
+        log.debug("pruned blocks #%s-#%s", evicted[0].index, evicted[-1].index)
+
+    def block_at(self, index):
+        """
+        Return the block at a given height.
+
+        Blocks evicted from memory are read back from the store, if there is one.
+
+        Returns:
+            Block: The block, or None if it is not held in memory or on disk.
+        """
+        base = self.chain[0].index
+        if index >= base:
+            return self.chain[index - base] if index - base < len(self.chain) else None
+        if self.store is not None and index >= 0:
+            return self.store.get(index)
+        return None
+
+    def leaderboard(self):
+        """
+        Return the win/loss/tie ledger as a list sorted by wins, best first.
+        """
+        return sorted(({"peer": peer, **entry} for peer, entry in self.ledger.items()),
+                      key=lambda e: (-e["wins"], e["losses"], e["peer"]))
+
     # for debugging
     def print_chain(self):
         """
@@ -238,10 +463,55 @@ class Blockchain:
         """
         Return the current chain height (last block index).
         """
-        return len(self.chain)-1
+        return self.chain[-1].index
     def tip(self):
         """
         Return the hash of the current tip block.
         """  
         return self.chain[-1].header_hash()
 
+
+class BlockStore:
+    """
+    Append-only file of evicted blocks, one JSON block per line.
+
+    Only the byte offset of each block is kept in memory, packed at 8 bytes
+    per height, so the store still grows by that much per evicted block.
+    """
+    def __init__(self, path):
+        """
+        Create (or truncate) the block file.
+
+        Args:
+            path (str): File the blocks are written to.
+        """
+        self.path = path
+        self.file = open(path, "wb+")
+        self.offsets = array.array("q")  # height -> byte offset, -1 if never stored
+        self.lock = threading.Lock()
+
+    def put(self, blk):
+        """
+        Append a block to the file.
+        """
+        with self.lock:
+            self.file.seek(0, 2)
+            if blk.index >= len(self.offsets):
+                self.offsets.extend([-1] * (blk.index + 1 - len(self.offsets)))
+            self.offsets[blk.index] = self.file.tell()
+            self.file.write(blk.to_json().encode() + b"\n")
+            self.file.flush()
+
+    def get(self, index):
+        """
+        Read a block back by height.
+
+        Returns:
+            Block: The block, or None if it was never stored.
+        """
+        with self.lock:
+            offset = self.offsets[index] if index < len(self.offsets) else -1
+            if offset < 0:
+                return None
+            self.file.seek(offset)
+            return Block.from_json(self.file.readline().decode())
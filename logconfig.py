@@ -0,0 +1,42 @@
+"""
+logconfig.py
+
+Logging setup shared by the tracker, peer and UI entry points.
+Log records are handed to a queue and written by a background listener
+thread, so logging never blocks the network or mining threads on stdout.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_FORMAT = "%(asctime)s %(levelname)-5s %(name)s: %(message)s"
+
+
+def setup_logging(level=None):
+    """
+    Route all logging through a queue-backed handler.
+
+    Args:
+        level (str, optional): Level name such as "DEBUG" or "INFO". Defaults
+            to the RPS_LOG_LEVEL environment variable, then "INFO".
+
+    Returns:
+        logging.handlers.QueueListener: The running listener.
+    """
+    level = (level or os.environ.get("RPS_LOG_LEVEL") or "INFO").upper()
+
+    records = queue.SimpleQueue()
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(records, console)
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,136 @@
+"""
+matchlog.py
+
+Bounded store for completed match records kept by the tracker.
+Holds the most recent records in a fixed-size ring buffer and can optionally
+append every record to a JSON-lines file so older pages stay reachable.
+"""
+
+import bisect
+import collections
+import json
+import os
+import threading
+
+
+class MatchLog:
+    """
+    Fixed-capacity, cursor-paginated log of match records.
+
+    Every record gets a monotonically increasing `seq`; a cursor is simply the
+    last `seq` a client has seen.
+    """
+    def __init__(self, capacity=1000, path=None, index_stride=64):
+        """
+        Create an empty match log.
+
+        Args:
+            capacity (int): Number of records kept in memory.
+            path (str, optional): JSON-lines file every record is appended to.
+                If it already exists, sequence numbers continue from it.
+            index_stride (int): Every this many records, the byte offset of a
+                record in the file is remembered so reads can seek near it.
+        """
+        self.records = collections.deque(maxlen=capacity)
+        self.path = path
+        self.next_seq = 1
+        self.lock = threading.Lock()
+        self.index_stride = index_stride
+        self.index_seqs = []  # sparse seq -> byte offset index into the file
+        self.index_offsets = []
+        self.end = 0  # bytes of complete records in the file
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in iter(f.readline, b''):
+                    if line.strip():
+                        seq = json.loads(line)['seq']
+                        self._index(seq, self.end)
+                        self.next_seq = seq + 1
+                    self.end += len(line)
+
+    def _index(self, seq, offset):
+        """
+        Remember where a record starts in the file if it falls on the stride.
+        """
+        if (seq - 1) % self.index_stride == 0:
+            self.index_seqs.append(seq)
+            self.index_offsets.append(offset)
+
+    def append(self, record):
+        """
+        Store a match record and assign it the next sequence number.
+
+        Args:
+            record (dict): JSON-serializable match record.
+
+        Returns:
+            dict: The stored record, including its `seq`.
+        """
+        with self.lock:
+            record = dict(record, seq=self.next_seq)
+            self.next_seq += 1
+            self.records.append(record)
+            if self.path is not None:
+                line = (json.dumps(record) + '\n').encode()
+                with open(self.path, 'ab') as f:
+                    f.write(line)
+                self._index(record['seq'], self.end)
+                self.end += len(line)
+        return record
+
+    def page(self, cursor=0, limit=100):
+        """
+        Return up to `limit` records with `seq` greater than `cursor`.
+
+        Records that have been evicted from memory are read back from the
+        on-disk log when one is configured; otherwise they are skipped and
+        `oldest` tells the caller where the retained history starts. The file
+        is read outside the lock, so appends never wait on a reader.
+
+        Args:
+            cursor (int): Last sequence number the caller has already seen.
+            limit (int): Maximum number of records to return.
+
+        Returns:
+            dict: `records`, `next_cursor` to pass on the next call, and `oldest`.
+        """
+        disk = None
+        with self.lock:
+            oldest = self.records[0]['seq'] if self.records else self.next_seq
+            if cursor + 1 < oldest and self.path is not None:
+                # nearest indexed record at or before the first one we want
+                i = bisect.bisect_right(self.index_seqs, cursor + 1) - 1
+                disk = (self.index_offsets[i] if i >= 0 else 0, self.end)
+                oldest = 1
+            else:
+                records = []
+                if self.records:
+                    # seqs in the ring are contiguous, so we can index directly
+                    start = max(0, cursor + 1 - oldest)
+                    for i in range(start, min(start + limit, len(self.records))):
+                        records.append(self.records[i])
+        if disk is not None:
+            records = self._read_disk(cursor, limit, *disk)
+
+        next_cursor = records[-1]['seq'] if records else max(cursor, oldest - 1)
+        return {'records': records, 'next_cursor': next_cursor, 'oldest': oldest}
+
+    def _read_disk(self, cursor, limit, start, end):
+        """
+        Read up to `limit` records after `cursor` from the on-disk log.
+
+        Only bytes in [start, end) are read; `end` is where the file stopped
+        when the caller took the lock, so half-written lines are never seen.
+        """
+        records = []
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            while f.tell() < end and len(records) < limit:
+                line = f.readline()
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record['seq'] > cursor:
+                    records.append(record)
+        return records
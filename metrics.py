@@ -0,0 +1,221 @@
+"""
+metrics.py
+
+Lightweight metrics registry (counters, gauges, histograms) shared by
+Peer, Blockchain and Tracker, with Prometheus text rendering and merging
+of snapshots reported by many peers.
+"""
+
+import math
+import threading
+
+# Upper bounds (seconds) for latency histograms
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Counter:
+    """
+    Monotonically increasing value.
+    """
+    kind = "counter"
+
+    def __init__(self, help=""):
+        """
+        Create a counter starting at zero.
+        """
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Increase the counter by `amount`.
+        """
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        """
+        Return a JSON-serializable copy of the current value.
+        """
+        return {"type": self.kind, "help": self.help, "value": self.value}
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down.
+    """
+    kind = "gauge"
+
+    def set(self, value):
+        """
+        Replace the current value.
+        """
+        self.value = value
+
+    def dec(self, amount=1):
+        """
+        Decrease the gauge by `amount`.
+        """
+        self.inc(-amount)
+
+
+class Histogram:
+    """
+    Distribution of observed values in fixed buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, help="", buckets=DEFAULT_BUCKETS):
+        """
+        Create an empty histogram.
+
+        Args:
+            help (str): Description shown in /metrics.
+            buckets (tuple): Sorted upper bounds; +Inf is implicit.
+        """
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Record one observation.
+        """
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        Return a JSON-serializable copy of the buckets, sum and count.
+        """
+        with self.lock:
+            return {"type": self.kind, "help": self.help, "buckets": list(self.buckets),
+                    "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+
+class Registry:
+    """
+    Named collection of metrics.
+    """
+    def __init__(self):
+        """
+        Create an empty registry.
+        """
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        """
+        Return the metric called `name`, creating it on first use.
+        """
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(name, cls(help, **kwargs))
+        return metric
+
+    def counter(self, name, help=""):
+        """
+        Get or create a Counter.
+        """
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=""):
+        """
+        Get or create a Gauge.
+        """
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS):
+        """
+        Get or create a Histogram.
+        """
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def snapshot(self):
+        """
+        Return every metric as a JSON-serializable dict, e.g. for a peer report.
+        """
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def render(self):
+        """
+        Render the registry in Prometheus text exposition format.
+        """
+        return render(self.snapshot())
+
+
+def merge(snapshots):
+    """
+    Sum several registry snapshots into one (e.g. across all peers).
+
+    Counters, gauges and histogram buckets are added together; histograms
+    with the same name are assumed to share bucket bounds.
+
+    Args:
+        snapshots (iterable): Dicts returned by Registry.snapshot().
+
+    Returns:
+        dict: Combined snapshot.
+    """
+    merged = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            total = merged.get(name)
+            if total is None:
+                merged[name] = dict(metric, counts=list(metric["counts"])) \
+                    if metric["type"] == "histogram" else dict(metric)
+            elif metric["type"] == "histogram":
+                total["counts"] = [a + b for a, b in zip(total["counts"], metric["counts"])]
+                total["sum"] += metric["sum"]
+                total["count"] += metric["count"]
+            else:
+                total["value"] += metric["value"]
+    return merged
+
+
+def _number(value):
+    """
+    Format a sample value the way Prometheus expects.
+    """
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(snapshot):
+    """
+    Render a snapshot in Prometheus text exposition format.
+
+    Args:
+        snapshot (dict): Output of Registry.snapshot() or merge().
+
+    Returns:
+        str: Text for a /metrics response.
+    """
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        if metric["help"]:
+            lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        if metric["type"] == "histogram":
+            cumulative = 0
+            for bound, count in zip(metric["buckets"], metric["counts"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{_number(float(bound))}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {metric["count"]}')
+            lines.append(f"{name}_sum {_number(metric['sum'])}")
+            lines.append(f"{name}_count {metric['count']}")
+        else:
+            lines.append(f"{name} {_number(metric['value'])}")
+    return "\n".join(lines) + "\n"
@@ -6,18 +6,60 @@ Handles network connections, commit-reveal protocol, block proposals,
 and chain synchronization with proof-of-work and fork resolution.
 """
 
+import logging
+import os
 import secrets
 import socket
+import heapq
+import itertools
 import json
 import threading
 import random
 import time
 
-from blockchain import Blockchain, Block
+from blockchain import Blockchain, Block, BlockStore
 
 from utils import sha256, hash_json, pow_ok
 from threading import Condition
 from global_vars import TRACKER_PORT
+from metrics import Registry
+from logconfig import setup_logging
+import profiling
+
+log = logging.getLogger(__name__)
+
+
+class Match:
+    """
+    State of one match a peer is playing; a peer may play several at once.
+    """
+    def __init__(self, match_id, opponent_id, opp_addr, opp_port):
+        """
+        Create the state for a match announced by the tracker.
+
+        Args:
+            match_id (str): Match identifier from the tracker.
+            opponent_id (int): Opponent's peer ID.
+            opp_addr (str): Opponent's address.
+            opp_port (int): Opponent's game port.
+        """
+        self.match_id = match_id
+        self.opponent_id = opponent_id
+        self.opp_addr = opp_addr
+        self.opp_port = opp_port
+        self.result = None  # RESULT transaction once both moves are revealed
+        self.ended = False
+
+    def outcome_for(self, peer_id):
+        """
+        Return "win", "loss" or "tie" from one peer's point of view, or
+        "abandoned" if the match never got a result.
+        """
+        if self.result is None:
+            return "abandoned"
+        if self.result["winner"] == 0:
+            return "tie"
+        return "win" if self.result["winner"] == peer_id else "loss"
 
 
 class Peer:
@@ -40,14 +82,31 @@ class Peer:
         'scissorsrock': 'lost',
         'scissorspaper': 'win'
     }
-
-    def __init__(self, host='localhost', tracker_port=TRACKER_PORT):
+    # Mining work priorities: remines of orphaned matches go before new batches
+    REMINE, NEW_BLOCK = 0, 1
+    MINE_CHUNK = 20000  # hashes between checks for a new tip
+    REPORT_WINDOW = 50  # newest blocks sent to the tracker in a blockchain_update
+    REPORT_MIN_INTERVAL = 1.0  # seconds between reports triggered by accepted proposals
+    SYNC_CHUNK = 50  # blocks per BLOCKS_REQUEST while bootstrapping
+    SYNC_TIMEOUT = 2.0  # seconds to wait for a BLOCKS_RESPONSE before asking another peer
+    CHAIN_REQUEST_TIMEOUT = 5.0  # seconds before a CHAIN_REQUEST to the same peer may be repeated
+    MATCH_TIMEOUT = 30.0  # seconds to wait for the opponent's COMMIT or REVEAL
+
+    def __init__(self, host='localhost', tracker_port=TRACKER_PORT, report_interval=5,
+                 block_window=0.5, max_block_matches=32, finality_depth=100, block_store=None):
         """
         Initialize the Peer with network settings and blockchain state.
 
         Args:
             host (str): Address of the tracker server.
             tracker_port (int): Port of the tracker server.
+            report_interval (float): Seconds between metrics reports to the tracker.
+            block_window (float): Seconds to keep collecting completed matches
+                after the first one before mining them into a block.
+            max_block_matches (int): Matches that fill a block early.
+            finality_depth (int): Blocks kept in memory below the tip; older ones
+                are folded into a snapshot. None keeps the whole chain.
+            block_store (str, optional): File that evicted blocks are written to.
         """
         # Network connection properties
         self.host = host
@@ -58,26 +117,67 @@ class Peer:
         self.game_port = self.listen_socket.getsockname()[1]
         self.listen_socket.listen()
 
-        print(f"Listen Socket bound to port {self.game_port}")
+        log.info("Listen Socket bound to port %s", self.game_port)
 
         # Connection state
         self.connected = False
         self.peer_id = None
         self.network_peers = {}
+        self.roster_version = 0
+        self._roster_requested = False
 
         # Game state
-        self.opponent_id = None
-        self.match_result = None
-        self.current_match_id = None
-        self.commits = {}
+        self.matches = {}  # match_id -> Match currently being played
+        # (match_id, type, peer) -> COMMIT/REVEAL received from an opponent. Kept apart
+        # from the buffer, which a block proposal may clean before play_match looks.
+        self.received = {}
+        self._chain_requests = {}  # peer_id -> monotonic time a pending CHAIN_REQUEST expires
+
+        # Metrics, reported to the tracker every report_interval seconds
+        self.metrics = Registry()
+        self.report_interval = report_interval
+        self._last_report = 0.0  # monotonic time of the last blockchain_update
+        self._hashes = self.metrics.counter("rps_hashes_total", "Block header hashes computed while mining")
+        self._hash_rate = self.metrics.gauge("rps_hash_rate", "Hashes per second of the last mined block")
+        self._mining_time = self.metrics.histogram("rps_mining_seconds", "Time to mine one block")
+        self._proposals_sent = self.metrics.counter("rps_proposals_sent_total", "BLOCK_PROPOSAL messages sent")
+        self._proposals_received = self.metrics.counter("rps_proposals_received_total",
+                                                        "BLOCK_PROPOSAL messages received")
+        self._proposals_rejected = self.metrics.counter("rps_proposals_rejected_total",
+                                                        "Received proposals that did not change the chain")
+        self._mempool_size = self.metrics.gauge("rps_mempool_size",
+                                                "Transactions in play or waiting to be mined")
+        self._commit_result = self.metrics.histogram("rps_commit_result_seconds",
+                                                     "Time from sending a COMMIT to knowing the RESULT")
 
         # Blocks
-        self.blockchain = Blockchain()
+        self.blockchain = Blockchain(self.metrics, finality_depth,
+                                     BlockStore(block_store) if block_store else None)
         self.buffer = []
-        self.pending = []
-        self.lock = threading.Lock()
-        self.should_broadcast = True
-        self.cond = Condition()
+        # Plain locks unless profiling is on, then wait times are recorded.
+        # lock guards the buffer, the match table and the tracker socket.
+        self.lock = profiling.instrument_lock(threading.Lock(), "rps_peer_lock_wait_seconds",
+                                              self.metrics, "Time spent waiting for Peer.lock")
+        self.cond = Condition(profiling.instrument_lock(threading.RLock(), "rps_peer_cond_wait_seconds",
+                                                        self.metrics, "Time spent waiting for Peer.cond"))
+
+        # Block assembly and mining. ready guards completed, work and tip_version.
+        self.block_window = block_window
+        self.max_block_matches = max_block_matches
+        self.completed = []  # transaction lists of completed matches, oldest first
+        self.work = []  # heap of (priority, seq, transactions) for the mining worker
+        self._work_seq = itertools.count()
+        self.tip_version = 0  # bumped whenever the local tip changes
+        self.ready = Condition()
+
+        # Bootstrap: set while downloading the chain after joining a running network.
+        # sync_cond guards syncing, sync_responses and sync_buffer.
+        self.syncing = False
+        self.sync_responses = {}  # requested start height -> BLOCKS_RESPONSE
+        self.sync_buffer = []  # (sender, block) proposals that arrived during sync
+        self.sync_cond = Condition()
+        self._block_matches = self.metrics.histogram("rps_block_matches", "Matches packed into each mined block",
+                                                     buckets=(1, 2, 4, 8, 16, 32, 64, 128))
 
     def _send_once(self, addr, port, obj):
         """
@@ -91,10 +191,139 @@ class Peer:
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((addr, port))
-            s.send(json.dumps(obj).encode() + b'\n')
+            s.sendall(json.dumps(obj).encode() + b'\n')
         finally:
             s.close()
 
+    def _send_tracker(self, obj):
+        """
+        Send a JSON message to the tracker.
+
+        Several match threads report at once, so whole lines are written
+        under the lock to keep them from interleaving.
+
+        Args:
+            obj (dict): JSON message.
+        """
+        data = (json.dumps(obj) + "\n").encode()
+        with self.lock:
+            self.tracker_socket.sendall(data)
+
+    def _mine(self, txs):
+        """
+        Mine transactions on top of the current tip, recording hash rate and mining time.
+
+        Works in chunks of MINE_CHUNK hashes. Whenever the tip changes in
+        between, the block is retargeted onto the new tip and transactions
+        of matches that are already on the chain are dropped.
+
+        Args:
+            txs (list): Transactions to put in the block.
+
+        Returns:
+            Block: The mined block, or None if every match got included elsewhere.
+        """
+        start = time.perf_counter()
+        hashes = 0
+        version = None
+        blk = None
+        while True:
+            if version != self.tip_version:
+                with self.cond:
+                    version = self.tip_version
+                    txs = [tx for tx in txs if tx.get("match_id") not in self.blockchain.included]
+                    if not txs:
+                        return None
+                    if blk is not None:
+                        log.debug("[%s] tip moved, retargeting blk #%s", self.peer_id, blk.index)
+                    blk = Block(self.blockchain.height() + 1, self.blockchain.tip(), transactions=txs)
+            tried = blk.mine(self.MINE_CHUNK)
+            hashes += tried
+            self._hashes.inc(tried)
+            if pow_ok(blk.header_hash()):
+                break
+        elapsed = time.perf_counter() - start
+        self._mining_time.observe(elapsed)
+        if elapsed > 0:
+            self._hash_rate.set(hashes / elapsed)
+        return blk
+
+    def _push_work(self, priority, txs):
+        """
+        Hand transactions to the mining worker.
+
+        Args:
+            priority (int): REMINE or NEW_BLOCK.
+            txs (list): Transactions to mine.
+        """
+        with self.ready:
+            heapq.heappush(self.work, (priority, next(self._work_seq), txs))
+            self.ready.notify_all()
+
+    def _tip_changed(self, orphaned=()):
+        """
+        Tell the mining worker the tip moved, and requeue matches we mined in orphaned blocks.
+
+        Must be called with self.cond held.
+
+        Args:
+            orphaned (iterable): Blocks that just left the local chain.
+        """
+        with self.ready:
+            self.tip_version += 1
+        final = self.blockchain.snapshot["height"] if self.blockchain.snapshot else 0
+        for blk in orphaned:
+            if blk.index <= final:
+                continue  # folded into the snapshot; `included` no longer tracks its matches
+            # the lower peer id of a match mines it, so only it requeues the match
+            players = {}
+            for tx in blk.transactions:
+                if tx.get("type") == "COMMIT":
+                    players.setdefault(tx["match_id"], []).append(tx["peer"])
+            ours = {m for m, ids in players.items()
+                    if min(ids) == self.peer_id and m not in self.blockchain.included}
+            if ours:
+                log.info("[%s] requeueing %s matches from orphaned blk #%s", self.peer_id, len(ours), blk.index)
+                self._push_work(self.REMINE, [tx for tx in blk.transactions if tx.get("match_id") in ours])
+
+    def _broadcast_block(self, blk):
+        """
+        Send a BLOCK_PROPOSAL for a block to every other peer in the network.
+
+        Args:
+            blk (Block): Block to propose.
+        """
+        # the roster can change under us while we are sending
+        for pid, info in list(self.network_peers.items()):
+            if pid == self.peer_id:  # skip myself
+                continue
+            try:
+                self._send_once(info["address"], info["port"],
+                                {"type": "BLOCK_PROPOSAL", "peer": self.peer_id, "block": blk.to_json()})
+            except OSError as e:
+                # a peer that just left must not stop the block reaching everyone else
+                log.warning("[%s] BLOCK_PROPOSAL to peer %s failed: %s", self.peer_id, pid, e)
+                continue
+            self._proposals_sent.inc()
+
+    def report_metrics(self):
+        """
+        Thread to periodically send a snapshot of this peer's metrics to the tracker
+        """
+        while self.connected:
+            time.sleep(self.report_interval)
+            with self.lock:
+                in_play = len(self.buffer)
+            with self.ready:
+                queued = sum(len(txs) for txs in self.completed) + sum(len(txs) for _, _, txs in self.work)
+            self._mempool_size.set(in_play + queued)
+            report = {
+                'type': 'metrics_report',
+                'peer_id': self.peer_id,
+                'metrics': self.metrics.snapshot()
+            }
+            self._send_tracker(report)
+
     def _clean_buffer(self, block):
         """
         Remove transactions from the buffer that are included in the given block.
@@ -106,20 +335,21 @@ class Peer:
                           for tx in block.transactions if "type" in tx}
 
         # Keep only transactions not in the block
-        self.buffer = [tx for tx in self.buffer if
-                       (tx.get("match_id", ""), tx.get("type", ""), tx.get("peer", 0))
-                       not in txids_in_block]
+        with self.lock:
+            self.buffer = [tx for tx in self.buffer if
+                           (tx.get("match_id", ""), tx.get("type", ""), tx.get("peer", 0))
+                           not in txids_in_block]
 
     def handle_peer_connections(self):
         """
         Accept incoming peer connections and spawn handler threads.
         """
 
-        print(f"Listening for peer messages on port {self.game_port}")
+        log.info("Listening for peer messages on port %s", self.game_port)
         while self.connected:
-            print(f"WAITING FOR PEER CONNECTIONS ON PORT {self.game_port}")
+            log.debug("waiting for peer connections on port %s", self.game_port)
             client_socket, address = self.listen_socket.accept()
-            print(f"Accepted connection from {address}")
+            log.debug("Accepted connection from %s", address)
             thread = threading.Thread(target=self.handle_peer_message, args=(client_socket,))
             thread.daemon = True
             thread.start()
@@ -133,7 +363,7 @@ class Peer:
         """
         buffer = ""
         while True:
-            print("Reading message from peer...")
+            log.debug("Reading message from peer...")
             chunk = client_socket.recv(4096).decode()
             if not chunk:
                 break
@@ -147,69 +377,63 @@ class Peer:
 
                 # ----- store game transactions -----
                 if msg["type"] in ("COMMIT", "REVEAL", "RESULT"):
-                    self.buffer.append(msg)
-                    if msg["type"] == "COMMIT":
-                        self.commits[(msg["match_id"], msg["peer"])] = msg["hash"]
-                    print(f"Received peer message: {msg}")
+                    with self.lock:
+                        self.buffer.append(msg)
+                        self.received[(msg["match_id"], msg["type"], msg.get("peer"))] = msg
+                    log.debug("Received peer message: %s", msg)
 
                 elif msg["type"] == "BLOCK_PROPOSAL":
                     sender = msg["peer"]
                     blk = Block.from_json(msg["block"])
 
-                    # check if block proposal is from match oppoent
-                    is_opponent = self.current_match_id is not None and \
-                                  any(t["type"] == "RESULT" and t["match_id"] == self.current_match_id
-                                      for t in blk.transactions)
+                    log.debug("[%s] got BLOCK_PROPOSAL for block %s from %s", self.peer_id, blk.index, sender)
 
-                    print(f"[DEBUG peer] got BLOCK_PROPOSAL for block {blk.index} from {sender}")
+                    self._proposals_received.inc()
 
-                    # grab the lock
-                    with self.cond:
-                        self.should_broadcast = False
+                    with self.sync_cond:
+                        if self.syncing:
+                            # replayed once the downloaded chain is in place
+                            self.sync_buffer.append((sender, blk))
+                            continue
+                    self._on_proposal(sender, blk)
 
-                        # add block proposal to local block chain
-                        self.blockchain.add(blk)
-                        self._clean_buffer(blk)
-                        #self.blockchain.print_chain()
-
-                        if is_opponent:
-                            self.end_game()
-                            self.current_match_id = None
-
-                        # ensure there arent any pending blocks
-                        got_pending = self.cond.wait_for(lambda: bool(self.pending), timeout=0.3)
-
-                        if not got_pending:
-                            print(f"[{self.peer_id}] no pending blocks to remine")
-                        else:
-                            # remine pending block
-                            pending_blk = self.pending.pop(0)
-                            old_index = pending_blk.index
-                            pending_blk.index = self.blockchain.height() + 1
-                            pending_blk.prev = self.blockchain.tip()
-                            pending_blk.nonce = 0
-                            pending_blk.mine()
-
-                            print(f"[{self.peer_id}] remined pending blk #{old_index} to new blk #{pending_blk.index}")
-                            self.blockchain.add(pending_blk)
-                            #self.blockchain.print_chain()
-                            self._clean_buffer(pending_blk)
-
-                            # broadcast the remined block
-                            print(f"[{self.peer_id}] broadcasting to peers blk #{pending_blk.index}")
-                            for pid, info in self.network_peers.items():
-                                if pid == self.peer_id: continue
-                                self._send_once(
-                                    info["address"], info["port"],
-                                    {"type": "BLOCK_PROPOSAL", "peer": self.peer_id, "block": pending_blk.to_json()}
-                                )
+                elif msg["type"] == "BLOCKS_REQUEST":
+                    # a bootstrapping peer wants heights start..end
+                    start = msg["start"]
+                    end = min(msg["end"], start + 10 * self.SYNC_CHUNK)
+                    blocks = []
+                    with self.cond:
+                        for i in range(start, min(end, self.blockchain.height()) + 1):
+                            blk = self.blockchain.block_at(i)
+                            if blk is None and not blocks:
+                                continue  # pruned; send what we still hold
+                            if blk is None:
+                                break
+                            blocks.append(blk.to_json())
+                        pruned = not blocks or json.loads(blocks[0])["header"]["index"] > start
+                        snapshot = self.blockchain.snapshot if pruned else None
+                    self._send_once(msg["reply_addr"], msg["reply_port"], {
+                        "type": "BLOCKS_RESPONSE",
+                        "start": start,
+                        "blocks": blocks,
+                        "snapshot": snapshot,
+                        "from_peer": self.peer_id
+                    })
 
+                elif msg["type"] == "BLOCKS_RESPONSE":
+                    with self.sync_cond:
+                        self.sync_responses[msg["start"]] = msg
+                        self.sync_cond.notify_all()
 
                 elif msg["type"] == "CHAIN_REQUEST":
-                    chain_json = [blk.to_json() for blk in self.blockchain.chain]
+                    with self.cond:
+                        chain_json = [blk.to_json() for blk in self.blockchain.chain]
+                        snapshot = self.blockchain.snapshot
+                    # blocks we still hold, plus the snapshot they build on
                     response = {
                         "type": "CHAIN_RESPONSE",
                         "chain": chain_json,
+                        "snapshot": snapshot,
                         "from_peer": self.peer_id
                     }
                     addr = msg["reply_addr"]
@@ -220,33 +444,202 @@ class Peer:
                     # peer sent their chain
                     new_chain = []
                     sender = msg["from_peer"]
+                    with self.lock:
+                        self._chain_requests.pop(sender, None)
                     for blk_json in msg["chain"]:
                         new_chain.append(Block.from_json(blk_json))
 
-                    print(f"[{self.peer_id}] adopting chain of length {len(new_chain)} from {sender}")
-                    self.blockchain.chain = new_chain
+                    with self.cond:
+                        if new_chain[-1].index <= self.blockchain.height():
+                            continue  # caught up some other way meanwhile
+                        # blocks below the received window are shared history, not orphans
+                        kept = {b.header_hash() for b in new_chain}
+                        orphaned = [b for b in self.blockchain.chain
+                                    if b.index >= new_chain[0].index and b.header_hash() not in kept]
+                        if not self.blockchain.replace(new_chain, msg.get("snapshot")):
+                            log.warning("[%s] chain from %s does not connect to ours", self.peer_id, sender)
+                            continue
+                        log.info("[%s] adopted chain up to #%s from %s", self.peer_id, new_chain[-1].index, sender)
+                        self._tip_changed(orphaned)
 
                     # need to double check cleaning the buffer
                     for blk in new_chain:
                         self._clean_buffer(blk)
 
+    def _on_proposal(self, sender, blk):
+        """
+        Add a proposed block to the local chain.
+
+        Args:
+            sender (int): Peer that proposed the block.
+            blk (Block): The proposed block.
+        """
+        accepted = catch_up = False
+        # grab the lock; mining happens on the worker, never here
+        with self.cond:
+            old_tip = self.blockchain.chain[-1]
+            # add block proposal to local block chain
+            if self.blockchain.add(blk):
+                accepted = True
+                replaced = self.blockchain.chain[-1] is not old_tip and \
+                           self.blockchain.chain[-2] is not old_tip
+                self._tip_changed([old_tip] if replaced else [])
+            else:
+                self._proposals_rejected.inc()
+                # concurrent matches fork more than one block deep;
+                # catch up with a sender that is ahead of us
+                catch_up = blk.index > self.blockchain.height() and sender in self.network_peers
+        if catch_up:
+            self.request_full_chain(sender)
+        self._clean_buffer(blk)
+        # keep our height fresh at the tracker (sync_info relies on it), at most once per interval
+        if accepted and time.monotonic() - self._last_report >= self.REPORT_MIN_INTERVAL:
+            self._report_chain()
+        #self.blockchain.print_chain()
+
+    def _request_blocks(self, source, start, end):
+        """
+        Ask a peer for the blocks at heights start..end.
+
+        Args:
+            source (dict): Entry from sync_info with address and port.
+            start (int): First height.
+            end (int): Last height.
+        """
+        try:
+            self._send_once(source["address"], source["port"], {
+                "type": "BLOCKS_REQUEST",
+                "start": start,
+                "end": end,
+                "from_peer": self.peer_id,
+                "reply_addr": self.host,
+                "reply_port": self.game_port
+            })
+        except OSError as e:
+            log.warning("[%s] BLOCKS_REQUEST to peer %s failed: %s", self.peer_id, source["peer_id"], e)
+
+    def _await_blocks(self, start):
+        """
+        Wait up to SYNC_TIMEOUT for the response to a request starting at `start`.
+
+        Returns:
+            dict: The BLOCKS_RESPONSE, or None on timeout.
+        """
+        with self.sync_cond:
+            self.sync_cond.wait_for(lambda: start in self.sync_responses, timeout=self.SYNC_TIMEOUT)
+            return self.sync_responses.pop(start, None)
+
+    def bootstrap(self, target, sources):
+        """
+        Download the chain from several peers in parallel after joining a running network.
+
+        The first chunk comes from the best source and tells us whether its
+        history starts at genesis or at a snapshot. Every remaining chunk is
+        then requested at once, spread round-robin over the sources, and
+        validated in height order as the responses arrive. A chunk that
+        times out or comes back short is asked for again from a source
+        that may still hold it. Block proposals that arrive meanwhile are buffered and
+        replayed on top of the downloaded chain.
+
+        Args:
+            target (int): Best chain height the tracker knows of.
+            sources (list): Peers to download from, best first.
+        """
+        started = time.perf_counter()
+        blocks = []
+        snapshot = None
+        try:
+            try:
+                # probe: also tells us where the best source's history starts
+                self._request_blocks(sources[0], 1, self.SYNC_CHUNK)
+                probe = self._await_blocks(1)
+                if probe is None:
+                    raise TimeoutError(f"no response from peer {sources[0]['peer_id']}")
+                chunk = [Block.from_json(js) for js in probe["blocks"]]
+                if not chunk or chunk[0].index > 1:
+                    # the source pruned its early history; start from its snapshot
+                    snapshot = probe["snapshot"]
+                    if snapshot is None or (chunk and snapshot["height"] + 1 != chunk[0].index):
+                        raise ValueError("pruned range without a matching snapshot")
+                prev_index, prev_hash = (snapshot["height"], snapshot["tip"]) if snapshot else \
+                    (0, self.blockchain.chain[0].header_hash())
+
+                # fan out the remaining ranges
+                first = (chunk[-1].index if chunk else prev_index) + 1
+                ranges = list(range(first, target + 1, self.SYNC_CHUNK))
+                for i, start in enumerate(ranges):
+                    self._request_blocks(sources[i % len(sources)], start, min(start + self.SYNC_CHUNK - 1, target))
+
+                # validate in height order while the other chunks are still downloading
+                attempt = 0
+                floors = {}  # peer_id -> lowest height it still holds, learnt from short responses
+                while True:
+                    for blk in chunk:
+                        if not self.blockchain.valid_after(blk, prev_index, prev_hash):
+                            raise ValueError(f"invalid block #{blk.index}")
+                        prev_index, prev_hash = blk.index, blk.header_hash()
+                        blocks.append(blk)
+                        attempt = 0
+                    if prev_index >= target:
+                        break
+                    response = self._await_blocks(prev_index + 1)
+                    chunk = [Block.from_json(js) for js in response["blocks"]] if response else []
+                    if not chunk or chunk[0].index != prev_index + 1:
+                        # timed out, or the source no longer holds these heights; ask another one
+                        start = prev_index + 1
+                        if chunk:
+                            floors[response["from_peer"]] = chunk[0].index
+                        candidates = [s for s in sources if floors.get(s["peer_id"], 0) <= start]
+                        attempt += 1
+                        if not candidates or attempt > 2 * len(sources):
+                            raise TimeoutError(f"gave up on block #{start}")
+                        self._request_blocks(candidates[attempt % len(candidates)], start,
+                                             min(start + self.SYNC_CHUNK - 1, target))
+                        chunk = []
+            except (TimeoutError, ValueError, KeyError, TypeError, OSError) as e:
+                # a source that timed out, went away or sent a malformed response
+                log.warning("[%s] bootstrap stopped at #%s: %s", self.peer_id,
+                            blocks[-1].index if blocks else 0, e)
+                # fall back to the old single-peer catch-up
+                if sources[0]["peer_id"] in self.network_peers:
+                    self.request_full_chain(sources[0]["peer_id"])
+
+            with self.cond:
+                if blocks and blocks[-1].index > self.blockchain.height():
+                    self.blockchain.replace(blocks, snapshot)
+                    self._tip_changed()
+        finally:
+            # whatever happened, resume mining and stop buffering proposals
+            with self.sync_cond:
+                self.syncing = False
+                buffered, self.sync_buffer = self.sync_buffer, []
+                self.sync_responses.clear()
+            with self.ready:
+                self.ready.notify_all()
+            log.info("[%s] bootstrapped to #%s in %.2fs from %s peers, replaying %s proposals",
+                     self.peer_id, self.blockchain.height(), time.perf_counter() - started, len(sources),
+                     len(buffered))
+            for sender, blk in buffered:
+                self._on_proposal(sender, blk)
+
     def self_check(self):
         """
         Detect errors in the node’s local blockchain (e.g. a shorter blockchain, duplicate blocks, 
         etxra blocks)
         """
-        for i in range(1, len(self.blockchain.chain)):
+        chain = self.blockchain.chain  # blocks still in memory
+        for i in range(1, len(chain)):
             # check index
-            if self.blockchain.chain[i].index != i:
+            if chain[i].index != chain[i - 1].index + 1:
                 return False
             # check hash
-            if self.blockchain.chain[i].prev != self.blockchain.chain[i - 1].header_hash():
+            if chain[i].prev != chain[i - 1].header_hash():
                 return False
             # check proof of work
-            if not pow_ok(self.blockchain.chain[i].header_hash()):
+            if not pow_ok(chain[i].header_hash()):
                 return False
 
-        hashes = [blk.header_hash() for blk in self.blockchain.chain]
+        hashes = [blk.header_hash() for blk in chain]
         if len(hashes) != len(set(hashes)):
             return False
 
@@ -255,32 +648,80 @@ class Peer:
     def request_full_chain(self, target_peer_id):
         """
         Ask peer with longest chain to send their blockchain
+
+        Skipped while an earlier request to the same peer is still pending.
+        Connects to the peer, so never call it with `cond` held.
+
+        Returns:
+            bool: True if a request was sent.
         """
-        info = self.network_peers[target_peer_id]
+        now = time.monotonic()
+        with self.lock:
+            if self._chain_requests.get(target_peer_id, 0) > now:
+                return False
+            self._chain_requests[target_peer_id] = now + self.CHAIN_REQUEST_TIMEOUT
+        info = self.network_peers.get(target_peer_id)
+        if info is None:
+            return False
         request = {
             "type": "CHAIN_REQUEST",
             "from_peer": self.peer_id,
             "reply_addr": self.host,
             "reply_port": self.game_port
         }
-        self._send_once(info["address"], info["port"], request)
+        try:
+            self._send_once(info["address"], info["port"], request)
+        except OSError as e:
+            # keep the pending entry so a gone peer is not retried on every proposal
+            log.warning("[%s] CHAIN_REQUEST to peer %s failed: %s", self.peer_id, target_peer_id, e)
+            return False
+        return True
 
-    def play_match(self, opp_addr, opp_port, match_id):
+    def _match_txs(self, match_id):
+        """
+        Return the buffered transactions of one match.
+        """
+        return [t for t in self.buffer if t.get("match_id") == match_id]
+
+    def _await_opponent(self, match, kind):
+        """
+        Wait up to MATCH_TIMEOUT for the opponent's COMMIT or REVEAL for a match.
+
+        Returns:
+            dict: The opponent's transaction, or None if it never arrived.
+        """
+        key = (match.match_id, kind, match.opponent_id)
+        deadline = time.monotonic() + self.MATCH_TIMEOUT
+        while key not in self.received:
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.05)
+        return self.received[key]
+
+    def _abandon(self, match, reason):
+        """
+        Give up on a match whose opponent went away, so its slot and state are freed.
+        """
+        log.warning("[%s] abandoning %s against peer %s: %s", self.peer_id, match.match_id,
+                    match.opponent_id, reason)
+        self.end_game(match)
+        with self.lock:
+            self.buffer = [t for t in self.buffer if t.get("match_id") != match.match_id]
+            for kind in ("COMMIT", "REVEAL"):
+                self.received.pop((match.match_id, kind, match.opponent_id), None)
+
+    def play_match(self, match):
         """
         Connects to the opponent, sends opponent the choice,
         Receives opponents choice, and finally logs the win or loss
+
+        Args:
+            match (Match): The match to play.
         """
 
         #self.blockchain.print_chain()
-        self.should_broadcast = True
-
-        self.opponent_id = next(
-            pid for pid in self.network_peers.keys()
-            if pid != self.peer_id and
-            self.network_peers[pid]["address"] == opp_addr and
-            self.network_peers[pid]["port"] == opp_port
-        )
-        self.current_match_id = match_id
+        match_id = match.match_id
+        opp_addr, opp_port = match.opp_addr, match.opp_port
         move = random.choice(self.CHOICES)
         key = secrets.token_hex(4)  # 8-char random key
 
@@ -292,16 +733,18 @@ class Peer:
             "hash": sha256((move + key).encode()),
         }
 
-        self.buffer.append(commit)
-        self.commits[(match_id, self.peer_id)] = commit["hash"]
-        self._send_once(opp_addr, opp_port, commit)
+        with self.lock:
+            self.buffer.append(commit)
+        try:
+            self._send_once(opp_addr, opp_port, commit)
+        except OSError as e:
+            return self._abandon(match, e)
+        committed_at = time.perf_counter()
 
         # wait for opponent commit
-        while not any(
-                t["type"] == "COMMIT" and t["match_id"] == match_id and t["peer"] != self.peer_id
-                for t in self.buffer
-        ):
-            time.sleep(0.05)
+        opp_commit = self._await_opponent(match, "COMMIT")
+        if opp_commit is None:
+            return self._abandon(match, "no COMMIT")
 
         # REVEAL - show move + key
         reveal = {
@@ -312,20 +755,17 @@ class Peer:
             "key": key,
         }
 
-        self.buffer.append(reveal)
-        self._send_once(opp_addr, opp_port, reveal)
+        with self.lock:
+            self.buffer.append(reveal)
+        try:
+            self._send_once(opp_addr, opp_port, reveal)
+        except OSError as e:
+            return self._abandon(match, e)
 
         # wait for opponent reveal
-        while not any(
-                t["type"] == "REVEAL" and t["match_id"] == match_id and t["peer"] != self.peer_id
-                for t in self.buffer
-        ):
-            time.sleep(0.05)
-        opp = next(
-            t
-            for t in self.buffer
-            if t["type"] == "REVEAL" and t["match_id"] == match_id and t["peer"] != self.peer_id
-        )
+        opp = self._await_opponent(match, "REVEAL")
+        if opp is None:
+            return self._abandon(match, "no REVEAL")
 
         # RESULT – decide winner
         outcome = self.OUTCOMES[move + opp["move"]]
@@ -339,51 +779,102 @@ class Peer:
             else 0,
             "tie": outcome == "tie",
         }
-        self.buffer.append(result)
+        match.result = result
+        with self.lock:
+            self.buffer.append(result)
+        self._commit_result.observe(time.perf_counter() - committed_at)
+
+        log.info("[%s] %s moves: %s vs %s → %s", self.peer_id, match_id, move, opp['move'], outcome)
+
+        # MINING - lower peer ID mines the match, batched with its other completed matches
+        if (self.peer_id < match.opponent_id):
+            self.submit_match([commit, opp_commit, reveal, opp, result])
+
+        self._report_chain()
+        self.end_game(match)
+
+        # drop only this match's transactions; other matches are still in flight
+        with self.lock:
+            self.buffer = [t for t in self.buffer if t.get("match_id") != match_id]
+            for kind in ("COMMIT", "REVEAL"):
+                self.received.pop((match_id, kind, match.opponent_id), None)
+
+    def submit_match(self, txs):
+        """
+        Queue a completed match (2 commits, 2 reveals, 1 result) for the next block.
+
+        Args:
+            txs (list): The match's transactions.
+        """
+        with self.ready:
+            self.completed.append(txs)
+            self.ready.notify()
+
+    def assemble_blocks(self):
+        """
+        Thread that turns completed matches into block templates.
+
+        Waits for a first completed match, keeps collecting for block_window
+        seconds (or until max_block_matches are queued), then hands them all
+        to the mining worker as one block, so proof of work is paid once per
+        batch, not per match.
+        """
+        while self.connected:
+            with self.ready:
+                self.ready.wait_for(lambda: self.completed)
+                self.ready.wait_for(lambda: len(self.completed) >= self.max_block_matches,
+                                    timeout=self.block_window)
+                batch = self.completed[:self.max_block_matches]
+                del self.completed[:self.max_block_matches]
 
-        print(f"[{self.peer_id}] moves: {move} vs {opp['move']} → {outcome}")
+            self._block_matches.observe(len(batch))
+            self._push_work(self.NEW_BLOCK, [tx for txs in batch for tx in txs])
 
-        # MINING - lower peer ID mines the block
-        if (self.peer_id < self.opponent_id):
-            stored_height = self.blockchain.height() + 1
-            blk = Block(
-                self.blockchain.height() + 1,
-                self.blockchain.tip(),
-                transactions=self.buffer.copy()
-            )
-            blk.mine()  # busy‐loop incrementing nonce until pow_ok()
-            print(f"[{self.peer_id}] mined block #{blk.index} {blk.header_hash()[:12]}…")
+    def mine_blocks(self):
+        """
+        Mining worker: mines queued work one block at a time, remines first.
+        """
+        while self.connected:
+            with self.ready:
+                # nothing to build on until a bootstrap has finished
+                self.ready.wait_for(lambda: self.work and not self.syncing)
+                _, _, txs = heapq.heappop(self.work)
+
+            blk = self._mine(txs)  # busy‐loop incrementing nonce until pow_ok()
+            if blk is None:
+                continue
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[%s] mined block #%s %s…", self.peer_id, blk.index, blk.header_hash()[:12])
 
             # grab the lock
             with self.cond:
-                if self.should_broadcast:
-                    # check if should_broadcast has been set to false, for a max of 0.2s
-                    # no propposals received yet. broadcast to all peers
-                    print(f"No proposals received. Broadcasting to peers.")
-                    for pid, info in self.network_peers.items():
-                        if pid == self.peer_id:  # skip myself
-                            continue
-                        self._send_once(info["address"], info["port"],
-                                        {"type": "BLOCK_PROPOSAL", "peer": self.peer_id, "block": blk.to_json()})
-
-                    print(f"[{self.peer_id}] broadcased first. adding block #{blk.index} to local chain")
+                broadcast = blk.prev == self.blockchain.tip()
+                if broadcast:
+                    # no proposal moved the tip since the last chunk
+                    log.info("[%s] broadcast first. adding block #%s to local chain", self.peer_id, blk.index)
                     self.blockchain.add(blk)
-                else:
-                    # someone else broadcasted first. need to remine.
-                    print(f"[{self.peer_id}] added block #{blk.index} to pending block list")
-                    self.pending.append(blk)
-                    # let the handler know it can wake up immediately
-                    self.cond.notify_all()
-
-        local_blockchain = {
+                    self._tip_changed()
+            if not broadcast:
+                # someone else's block landed first. need to remine.
+                log.info("[%s] tip moved under blk #%s, queueing remine", self.peer_id, blk.index)
+                self._push_work(self.REMINE, blk.transactions)
+                continue
+
+            self._broadcast_block(blk)
+            self._report_chain()
+
+    def _report_chain(self):
+        """
+        Send the newest REPORT_WINDOW blocks and the standings to the tracker.
+        """
+        self._last_report = time.monotonic()
+        self._send_tracker({
             "type": "blockchain_update",
             "peer_id": self.peer_id,
-            "local_blockchain": [block.to_json() for block in self.blockchain.chain]
-        }
-
-        self.tracker_socket.send((json.dumps(local_blockchain) + "\n").encode())
-        self.end_game()
-        self.buffer.clear()
+            "local_blockchain": [block.to_json() for block in self.blockchain.chain[-self.REPORT_WINDOW:]],
+            "height": self.blockchain.height(),
+            "leaderboard": self.blockchain.leaderboard()
+        })
 
     def listen_for_tracker(self):
         """
@@ -414,7 +905,7 @@ class Peer:
         self.tracker_socket.send((json.dumps(init_message) + "\n").encode())
 
         self.connected = True
-        print(f"Connected to tracker at address: {self.host}:{self.tracker_port}")
+        log.info("Connected to tracker at address: %s:%s", self.host, self.tracker_port)
 
         self.tracker_thread = threading.Thread(target=self.listen_for_tracker)
         self.tracker_thread.daemon = True
@@ -425,67 +916,137 @@ class Peer:
         self.peer_thread.daemon = True
         self.peer_thread.start()
 
+        self.metrics_thread = threading.Thread(target=self.report_metrics)
+        self.metrics_thread.daemon = True
+        self.metrics_thread.start()
+
+        self.assembler_thread = threading.Thread(target=self.assemble_blocks)
+        self.assembler_thread.daemon = True
+        self.assembler_thread.start()
+
+        self.miner_thread = threading.Thread(target=self.mine_blocks)
+        self.miner_thread.daemon = True
+        self.miner_thread.start()
+
     def handle_tracker_message(self, message):
         """
         Thread to handle messages from the tracker
         """
         if message['type'] == 'peer_id':
             self.peer_id = message['peer_id']
-            print(f"Assigned peer ID: {self.peer_id}")
+            log.info("Assigned peer ID: %s", self.peer_id)
+
+        elif message['type'] == 'redirect':
+            # sharded trackers: our id belongs to another shard
+            log.info("Tracker redirected peer %s to %s:%s", message['peer_id'], message['address'], message['port'])
+            sock = socket.create_connection((message['address'], message['port']))
+            sock.sendall((json.dumps({
+                'type': 'init',
+                'game_port': self.game_port,
+                'peer_id': message['peer_id']
+            }) + "\n").encode())
+            with self.lock:
+                old, self.tracker_socket = self.tracker_socket, sock
+            old.close()
 
         elif message['type'] == 'network_update':
+            # full roster snapshot
             self.network_peers = {}
             for peer_id, info in message['peers'].items():
                 self.network_peers[int(peer_id)] = {
                     'address': info['address'],
                     'port': info['port']
                 }
+            self.roster_version = message.get('version', 0)
+            self._roster_requested = False
+
+        elif message['type'] == 'network_delta':
+            if message['version'] <= self.roster_version:
+                return  # already covered by a newer snapshot
+            if message['base_version'] != self.roster_version:
+                # missed an update; ask the tracker for a fresh snapshot
+                if not self._roster_requested:
+                    self._roster_requested = True
+                    self._send_tracker({'type': 'roster_request'})
+                return
+            for peer_id, info in message['joined'].items():
+                self.network_peers[int(peer_id)] = {
+                    'address': info['address'],
+                    'port': info['port']
+                }
+            for peer_id in message['left']:
+                self.network_peers.pop(peer_id, None)
+            self.roster_version = message['version']
+
+        elif message['type'] == 'sync_info':
+            sources = [p for p in message['peers'] if p['peer_id'] != self.peer_id]
+            if message['height'] > self.blockchain.height() and sources:
+                log.info("Bootstrapping to height %s from %s peers", message['height'], len(sources))
+                with self.sync_cond:
+                    self.syncing = True
+                threading.Thread(target=self.bootstrap, args=(message['height'], sources), daemon=True).start()
 
         elif message['type'] == 'match_start':
-            print("MATCH STARTING")
-            print(f"Match ID: {message['match_id']}")
-            print(f"Opponent ID: {message['opponent_id']}")
-            print(f"Opponent address: {message['opponent_addr']}:{message['opponent_game_port']}")
+            log.info("Match %s starting against peer %s at %s:%s", message['match_id'],
+                     message['opponent_id'], message['opponent_addr'], message['opponent_game_port'])
 
-            self.opponent_id = message['opponent_id']
+            match = Match(message['match_id'], message['opponent_id'],
+                          message['opponent_addr'], message['opponent_game_port'])
+            with self.lock:
+                self.matches[match.match_id] = match
             # Start play match thread between peers
-            opp_addr, opp_port = message["opponent_addr"], message["opponent_game_port"]
-            threading.Thread(
-                target=self.play_match, args=(opp_addr, opp_port, message["match_id"]), daemon=True
-            ).start()
-
-    def end_game(self):
-        """
-        End the game and send the result to the tracker
-        """
-        print("ENDING GAME")
-        # Find the match result from the blockchain
-        last_block = self.blockchain.chain[-1]
-        match_result = next(
-            (t for t in last_block.transactions if t["type"] == "RESULT" and t["match_id"] == self.current_match_id),
-            None
-        )
-
-        result_text = "tie"
-        if match_result:
-            if match_result["winner"] == self.peer_id:
-                result_text = "win"
-            elif match_result["winner"] != 0:
-                result_text = "loss"
+            threading.Thread(target=self.play_match, args=(match,), daemon=True).start()
+
+    def end_game(self, match):
+        """
+        End a match and send its result to the tracker.
+
+        Safe to call more than once; only the first call reports.
+
+        Args:
+            match (Match): The match that finished.
+        """
+        with self.lock:
+            if match.ended:
+                return
+            match.ended = True
+            self.matches.pop(match.match_id, None)
+        log.debug("ENDING GAME %s", match.match_id)
 
         game_result = {
             'type': 'game_end',
             'peer_id': self.peer_id,
-            'opponent_id': self.opponent_id,
-            'match_id': self.current_match_id,
-            'match_log': f'peer {self.peer_id} played peer {self.opponent_id} at {time.time()} with result {result_text}'
+            'opponent_id': match.opponent_id,
+            'match_id': match.match_id,
+            'result': match.outcome_for(self.peer_id),
+            'ended_at': time.time()
         }
-        self.tracker_socket.send((json.dumps(game_result) + "\n").encode())
-        print("Game ended - sent result to tracker")
-
+        self._send_tracker(game_result)
+        log.info("Game %s ended - sent result to tracker", match.match_id)
 
 if __name__ == "__main__":
-    peer = Peer()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="RPS blockchain peer")
+    parser.add_argument("--log-level", help="DEBUG, INFO, WARNING... (default: $RPS_LOG_LEVEL or INFO)")
+    parser.add_argument("--profile", metavar="DIR", help="write cProfile/tracemalloc/lock-wait dumps to DIR "
+                                                         "(default: $RPS_PROFILE, off if unset)")
+    parser.add_argument("--profile-interval", type=float, help="seconds between profile dumps (default: 30)")
+    parser.add_argument("--block-window", type=float, default=0.5,
+                        help="seconds to collect completed matches into one block (default: 0.5)")
+    parser.add_argument("--max-block-matches", type=int, default=32,
+                        help="matches that fill a block early (default: 32)")
+    parser.add_argument("--finality-depth", type=int, default=100,
+                        help="blocks kept in memory below the tip (default: 100)")
+    parser.add_argument("--block-store", metavar="PATH", help="also keep evicted blocks in this file")
+    parser.add_argument("--tracker-port", type=int, default=TRACKER_PORT,
+                        help=f"port of the tracker, or of any tracker shard (default: {TRACKER_PORT})")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    profiling.enable(args.profile, f"peer-{os.getpid()}", args.profile_interval)
+
+    peer = Peer(tracker_port=args.tracker_port, block_window=args.block_window, max_block_matches=args.max_block_matches,
+                finality_depth=args.finality_depth, block_store=args.block_store)
     peer.connect_to_tracker()
     while peer.connected:
-        pass
+        time.sleep(1)
@@ -0,0 +1,281 @@
+"""
+profiling.py
+
+Opt-in profiling for live peers and trackers.
+When enabled (--profile DIR or RPS_PROFILE=DIR), every thread started
+afterwards runs under its own cProfile profiler, tracemalloc samples the
+heap, and instrumented locks record how long threads wait for them.
+Everything is written to DIR every `interval` seconds:
+
+    <prefix>-<thread role>.prof   cumulative cProfile stats (open with pstats/snakeviz)
+    <prefix>-heap.snap            latest tracemalloc snapshot
+    <prefix>-heap.log             top allocation sites over time
+    <prefix>-locks.log            lock wait counts, totals and maxima over time
+
+When profiling is off, nothing is patched and instrument_lock() returns
+the lock it was given, so there is no overhead.
+"""
+
+import atexit
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+log = logging.getLogger(__name__)
+
+_active = None  # the running Profiler, if any
+
+
+class TimedLock:
+    """
+    Lock wrapper that records how long callers wait to acquire it.
+
+    Works with threading.Lock and threading.RLock, and can be passed to
+    threading.Condition.
+    """
+    def __init__(self, lock, name, histogram=None):
+        """
+        Wrap a lock.
+
+        Args:
+            lock: threading.Lock or threading.RLock to wrap.
+            name (str): Label used in the lock wait log.
+            histogram (metrics.Histogram, optional): Also observe waits here.
+        """
+        self._lock = lock
+        self.name = name
+        self.histogram = histogram
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Acquire the wrapped lock, timing the wait.
+        """
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        waited = time.perf_counter() - start
+        self.count += 1
+        self.total += waited
+        self.max = max(self.max, waited)
+        if self.histogram is not None:
+            self.histogram.observe(waited)
+        return acquired
+
+    def release(self):
+        """
+        Release the wrapped lock.
+        """
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def __getattr__(self, attr):
+        # Condition looks for RLock internals (_is_owned, _release_save, ...)
+        return getattr(self._lock, attr)
+
+
+class _Frozen:
+    """
+    Already-collected profile stats that pstats.Stats can load.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    """
+    Per-thread cProfile, tracemalloc sampling and lock wait tracking.
+    """
+    def __init__(self, directory, prefix, interval=30, frames=10):
+        """
+        Configure (but do not start) profiling.
+
+        Args:
+            directory (str): Where profile files are written.
+            prefix (str): File name prefix, e.g. "tracker" or "peer-1234".
+            interval (float): Seconds between dumps.
+            frames (int): Traceback depth kept by tracemalloc.
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.interval = interval
+        self.frames = frames
+        self.lock = threading.Lock()
+        self.live = {}      # role -> set of running cProfile.Profile
+        self.finished = {}  # role -> pstats.Stats of threads that have exited
+        self.locks = []
+
+    def start(self):
+        """
+        Start profiling the calling thread and every thread started later.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        tracemalloc.start(self.frames)
+
+        profiler = self
+        original_run = threading.Thread.run
+
+        def run(thread):
+            target = getattr(thread, "_target", None)
+            profiler._profile(getattr(target, "__name__", thread.name), original_run, thread)
+
+        threading.Thread.run = run
+
+        main = cProfile.Profile()
+        self._track("main", main)
+        main.enable()
+
+        threading.Thread(target=self._dump_loop, name="profile-dumper", daemon=True).start()
+        atexit.register(self.dump)
+        log.info("Profiling to %s every %ss", self.directory, self.interval)
+
+    def _track(self, role, prof):
+        """
+        Register a running profiler under a thread role.
+        """
+        with self.lock:
+            self.live.setdefault(role, set()).add(prof)
+
+    def _profile(self, role, run, thread):
+        """
+        Run a thread's body under a fresh profiler and fold its stats in afterwards.
+        """
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Python 3.12+ allows one profiler per process; the main
+            # thread's profiler already sees this thread
+            return run(thread)
+        self._track(role, prof)
+        try:
+            run(thread)
+        finally:
+            prof.disable()
+            with self.lock:
+                self.live[role].discard(prof)
+                if role in self.finished:
+                    self.finished[role].add(prof)
+                else:
+                    self.finished[role] = pstats.Stats(prof)
+
+    def instrument(self, lock, name, registry=None, help=""):
+        """
+        Wrap a lock so its wait time is tracked.
+        """
+        histogram = registry.histogram(name, help) if registry is not None else None
+        timed = TimedLock(lock, name, histogram)
+        self.locks.append(timed)
+        return timed
+
+    def dump(self):
+        """
+        Write the current profiles, heap snapshot and lock waits to disk.
+        """
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            roles = {role: list(profs) for role, profs in self.live.items()}
+            finished = {role: dict(stats.stats) for role, stats in self.finished.items()}
+
+        for role in set(roles) | set(finished):
+            stats = None
+            for prof in roles.get(role, []):
+                # snapshot without disabling the profiler of a running thread
+                prof.snapshot_stats()
+                frozen = _Frozen(dict(prof.stats))
+                if stats is None:
+                    stats = pstats.Stats(frozen)
+                else:
+                    stats.add(frozen)
+            if role in finished:
+                if stats is None:
+                    stats = pstats.Stats(_Frozen(finished[role]))
+                else:
+                    stats.add(_Frozen(finished[role]))
+            if stats is not None:
+                stats.dump_stats(self._path(f"{role}.prof"))
+
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(self._path("heap.snap"))
+        current, peak = tracemalloc.get_traced_memory()
+        with open(self._path("heap.log"), "a") as f:
+            f.write(f"== {stamp} current={current} peak={peak}\n")
+            for stat in snapshot.statistics("lineno")[:10]:
+                f.write(f"{stat}\n")
+
+        with open(self._path("locks.log"), "a") as f:
+            for timed in self.locks:
+                mean = timed.total / timed.count if timed.count else 0.0
+                f.write(f"{stamp} {timed.name} acquires={timed.count} wait_total={timed.total:.6f}s "
+                        f"wait_mean={mean:.6f}s wait_max={timed.max:.6f}s\n")
+
+    def _path(self, name):
+        """
+        Return the output path for one profile artifact.
+        """
+        return os.path.join(self.directory, f"{self.prefix}-{name}")
+
+    def _dump_loop(self):
+        """
+        Dump profiles every `interval` seconds.
+        """
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.dump()
+            except Exception as e:
+                log.warning("Profile dump failed: %s", e)
+
+
+def enable(directory=None, prefix="rps", interval=None):
+    """
+    Turn on profiling if a directory is given or RPS_PROFILE is set.
+
+    Args:
+        directory (str, optional): Output directory; defaults to $RPS_PROFILE.
+        prefix (str): File name prefix for this process.
+        interval (float, optional): Seconds between dumps; defaults to
+            $RPS_PROFILE_INTERVAL, then 30.
+
+    Returns:
+        Profiler: The running profiler, or None if profiling stays off.
+    """
+    global _active
+    directory = directory or os.environ.get("RPS_PROFILE")
+    if not directory or _active is not None:
+        return _active
+    interval = interval or float(os.environ.get("RPS_PROFILE_INTERVAL", 30))
+    _active = Profiler(directory, prefix, interval)
+    _active.start()
+    return _active
+
+
+def instrument_lock(lock, name, registry=None, help=""):
+    """
+    Track wait time on a lock when profiling is enabled.
+
+    Args:
+        lock: threading.Lock or threading.RLock.
+        name (str): Histogram name, also used in the lock wait log.
+        registry (metrics.Registry, optional): Registry that gets the histogram.
+        help (str): Histogram description.
+
+    Returns:
+        The lock itself when profiling is off, otherwise a TimedLock around it.
+    """
+    if _active is None:
+        return lock
+    return _active.instrument(lock, name, registry, help)
@@ -0,0 +1,317 @@
+"""
+shard.py
+
+Coordination for running several tracker processes side by side.
+Peers are spread over the trackers ("shards") by consistent hashing of
+their peer id. The shards share state through a SQLite file (the broker):
+which shards are alive, global peer and match ids, the roster with each
+peer's chain height, peers offered for cross-shard matches, and an event
+feed that carries roster changes and cross-shard match starts.
+"""
+
+import bisect
+import json
+import sqlite3
+import threading
+import time
+
+from utils import sha256
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping peer ids to shards.
+
+    Each shard is placed on the ring `replicas` times, so adding or removing
+    a shard only moves the peers that hashed to its points.
+    """
+    def __init__(self, shard_ids, replicas=64):
+        """
+        Build the ring.
+
+        Args:
+            shard_ids (iterable): Ids of the shards to place.
+            replicas (int): Points per shard.
+        """
+        self.shard_ids = frozenset(shard_ids)
+        self.points = sorted((self._hash(f"{shard_id}#{i}"), shard_id)
+                             for shard_id in self.shard_ids for i in range(replicas))
+        self.keys = [point for point, _ in self.points]
+
+    @staticmethod
+    def _hash(key):
+        """
+        Position of a key on the ring.
+        """
+        return int(sha256(str(key).encode())[:16], 16)
+
+    def owner(self, peer_id):
+        """
+        Return the shard responsible for a peer id, or None if the ring is empty.
+        """
+        if not self.points:
+            return None
+        i = bisect.bisect(self.keys, self._hash(peer_id)) % len(self.points)
+        return self.points[i][1]
+
+
+class Broker:
+    """
+    SQLite-backed state shared by tracker shards on one host.
+
+    Every method runs in its own transaction, so several tracker processes
+    can use the same file at once. A shard's own writes (roster changes,
+    heights, events) are batched into one sync() per poll.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS shards (
+            shard_id TEXT PRIMARY KEY, address TEXT, port INTEGER, http_port INTEGER, heartbeat REAL);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS peers (
+            peer_id INTEGER PRIMARY KEY, shard_id TEXT, address TEXT, port INTEGER, height INTEGER);
+        CREATE TABLE IF NOT EXISTS available (
+            peer_id INTEGER PRIMARY KEY, shard_id TEXT, address TEXT, port INTEGER, since REAL);
+        CREATE TABLE IF NOT EXISTS events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT, target TEXT, kind TEXT, body TEXT, created REAL);
+    """
+
+    def __init__(self, path, shard_timeout=5.0, event_ttl=60.0, busy_timeout=None):
+        """
+        Open (and create if needed) the broker database.
+
+        Args:
+            path (str): SQLite file shared by every shard.
+            shard_timeout (float): Seconds without a heartbeat before a shard is dead.
+            event_ttl (float): Seconds events are kept before being deleted.
+            busy_timeout (float, optional): Seconds to wait for another shard's
+                write lock; defaults to a fifth of shard_timeout. Must stay below
+                shard_timeout, or lock contention alone could declare a shard dead.
+        """
+        busy_timeout = shard_timeout / 5 if busy_timeout is None else busy_timeout
+        if busy_timeout >= shard_timeout:
+            raise ValueError("busy_timeout must be shorter than shard_timeout")
+        self.path = path
+        self.shard_timeout = shard_timeout
+        self.event_ttl = event_ttl
+        self.lock = threading.Lock()  # the connection is shared by the loop and Flask threads
+        self.db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+
+    def _transaction(self, fn):
+        """
+        Run fn(cursor) inside one write transaction and return its result.
+        """
+        with self.lock:
+            cur = self.db.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(cur)
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+            cur.execute("COMMIT")
+            return result
+
+    def _query(self, sql, args=()):
+        """
+        Run a read-only query and return every row.
+        """
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    # Shards
+
+    def register(self, shard_id, address, port, http_port=None):
+        """
+        Announce a shard, or refresh it if it is already registered.
+        """
+        self._transaction(lambda cur: cur.execute(
+            "INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, ?)",
+            (shard_id, address, port, http_port, time.time())))
+
+    def sync(self, shard_id, address, port, http_port=None, added=(), removed=(), heights=None, events=()):
+        """
+        Heartbeat a shard and apply its batched writes in one transaction.
+
+        Shards and events that have expired are forgotten on the way. If the
+        shard's own row is gone (other shards declared it dead), it is
+        registered again and the caller should republish its peers.
+
+        Args:
+            shard_id (str): The shard.
+            address (str): Address peers connect to.
+            port (int): Port peers connect to.
+            http_port (int, optional): Port of the shard's HTTP endpoints.
+            added (iterable): (peer_id, address, port) of peers that joined.
+            removed (iterable): Ids of peers that left.
+            heights (dict, optional): peer_id -> latest reported chain height.
+            events (iterable): (kind, body, target) events to publish, in order.
+
+        Returns:
+            bool: True if the shard had been dropped and was registered again.
+        """
+        def apply(cur):
+            now = time.time()
+            dead = [row[0] for row in cur.execute("SELECT shard_id FROM shards WHERE heartbeat < ?",
+                                                  (now - self.shard_timeout,))]
+            for dead_id in dead:
+                self._forget(cur, dead_id)
+            rejoined = cur.execute("SELECT 1 FROM shards WHERE shard_id = ?", (shard_id,)).fetchone() is None
+            cur.execute("INSERT INTO shards VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(shard_id) DO UPDATE SET heartbeat = excluded.heartbeat",
+                        (shard_id, address, port, http_port, now))
+            cur.executemany("INSERT OR REPLACE INTO peers (peer_id, shard_id, address, port) VALUES (?, ?, ?, ?)",
+                            [(peer_id, shard_id, peer_address, peer_port)
+                             for peer_id, peer_address, peer_port in added])
+            for peer_id in removed:
+                cur.execute("DELETE FROM peers WHERE peer_id = ?", (peer_id,))
+                cur.execute("DELETE FROM available WHERE peer_id = ?", (peer_id,))
+            cur.executemany("UPDATE peers SET height = ? WHERE peer_id = ?",
+                            [(height, peer_id) for peer_id, height in (heights or {}).items()])
+            cur.executemany("INSERT INTO events (origin, target, kind, body, created) VALUES (?, ?, ?, ?, ?)",
+                            [(shard_id, target, kind, json.dumps(body), now) for kind, body, target in events])
+            cur.execute("DELETE FROM events WHERE created < ?", (now - self.event_ttl,))
+            return rejoined
+        return self._transaction(apply)
+
+    def unregister(self, shard_id):
+        """
+        Remove a shard together with its peers and offers.
+        """
+        self._transaction(lambda cur: self._forget(cur, shard_id))
+
+    @staticmethod
+    def _forget(cur, shard_id):
+        """
+        Delete every row that belongs to a shard.
+        """
+        for table in ("shards", "peers", "available"):
+            cur.execute(f"DELETE FROM {table} WHERE shard_id = ?", (shard_id,))
+
+    def live_shards(self):
+        """
+        Return the shards that sent a heartbeat recently.
+
+        Returns:
+            dict: shard_id -> {"address", "port", "http_port"}.
+        """
+        rows = self._query("SELECT shard_id, address, port, http_port FROM shards WHERE heartbeat >= ?",
+                           (time.time() - self.shard_timeout,))
+        return {shard_id: {"address": address, "port": port, "http_port": http_port}
+                for shard_id, address, port, http_port in rows}
+
+    def allocate(self, name, count=1):
+        """
+        Reserve the next `count` values of a global counter, which starts at 1.
+
+        Args:
+            name (str): Counter name, e.g. "peer" or "match".
+            count (int): How many consecutive values to reserve.
+
+        Returns:
+            int: The first reserved value.
+        """
+        def bump(cur):
+            row = cur.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+            first = row[0] + 1 if row else 1
+            cur.execute("INSERT OR REPLACE INTO counters VALUES (?, ?)", (name, first + count - 1))
+            return first
+        return self._transaction(bump)
+
+    # Roster
+
+    def peers(self):
+        """
+        Return every peer of every live shard.
+
+        Returns:
+            list: {"peer_id", "shard_id", "address", "port", "height"} dicts.
+        """
+        rows = self._query("SELECT p.peer_id, p.shard_id, p.address, p.port, p.height FROM peers p "
+                           "JOIN shards s ON s.shard_id = p.shard_id WHERE s.heartbeat >= ?",
+                           (time.time() - self.shard_timeout,))
+        return [{"peer_id": peer_id, "shard_id": shard_id, "address": address, "port": port, "height": height}
+                for peer_id, shard_id, address, port, height in rows]
+
+    # Cross-shard matchmaking
+
+    def offer(self, shard_id, peers):
+        """
+        Put peers with a free match slot on the board for other shards to claim.
+
+        Args:
+            shard_id (str): Shard that owns the peers.
+            peers (list): {"peer_id", "address", "port", "since"} dicts.
+        """
+        self._transaction(lambda cur: cur.executemany(
+            "INSERT OR REPLACE INTO available VALUES (?, ?, ?, ?, ?)",
+            [(p["peer_id"], shard_id, p["address"], p["port"], p["since"]) for p in peers]))
+
+    def withdraw(self, shard_id):
+        """
+        Take back a shard's offers that nobody claimed.
+
+        Returns:
+            list: Peer ids whose offers were still on the board.
+        """
+        def take_back(cur):
+            ids = [row[0] for row in cur.execute("SELECT peer_id FROM available WHERE shard_id = ?",
+                                                 (shard_id,))]
+            cur.execute("DELETE FROM available WHERE shard_id = ?", (shard_id,))
+            return ids
+        return self._transaction(take_back)
+
+    def claim(self, shard_id, exclude=(), match=None):
+        """
+        Atomically take the longest-waiting offer from another live shard.
+
+        Args:
+            shard_id (str): Shard doing the claiming; its own offers are skipped.
+            exclude (iterable): Peer ids that must not be claimed.
+            match (dict, optional): Body of a `match_start` event for the
+                offering shard. It is published in the same transaction as the
+                claim, with the claimed peer's id added as `peer_id`, so the
+                offer never disappears without the event.
+
+        Returns:
+            dict: The claimed {"peer_id", "shard_id", "address", "port"}, or None.
+        """
+        exclude = list(exclude)
+
+        def take(cur):
+            now = time.time()
+            row = cur.execute(
+                "SELECT a.peer_id, a.shard_id, a.address, a.port FROM available a "
+                "JOIN shards s ON s.shard_id = a.shard_id "
+                f"WHERE a.shard_id != ? AND s.heartbeat >= ? AND a.peer_id NOT IN ({','.join('?' * len(exclude))}) "
+                "ORDER BY a.since LIMIT 1",
+                (shard_id, now - self.shard_timeout, *exclude)).fetchone()
+            if row is None:
+                return None
+            cur.execute("DELETE FROM available WHERE peer_id = ?", (row[0],))
+            if match is not None:
+                cur.execute("INSERT INTO events (origin, target, kind, body, created) VALUES (?, ?, ?, ?, ?)",
+                            (shard_id, row[1], "match_start", json.dumps(dict(match, peer_id=row[0])), now))
+            return {"peer_id": row[0], "shard_id": row[1], "address": row[2], "port": row[3]}
+        return self._transaction(take)
+
+    # Events
+
+    def events(self, shard_id, after):
+        """
+        Return the events for a shard published after sequence number `after`.
+
+        Returns:
+            list: (seq, origin, kind, body) tuples, oldest first.
+        """
+        rows = self._query("SELECT seq, origin, kind, body FROM events WHERE seq > ? AND origin != ? "
+                           "AND (target IS NULL OR target = ?) ORDER BY seq",
+                           (after, shard_id, shard_id))
+        return [(seq, origin, kind, json.loads(body)) for seq, origin, kind, body in rows]
+
+    def last_event(self):
+        """
+        Return the sequence number of the newest event, or 0.
+        """
+        return self._query("SELECT COALESCE(MAX(seq), 0) FROM events")[0][0]
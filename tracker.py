@@ -4,17 +4,37 @@ tracker.py
 Tracker server for the Rock-Paper-Scissors blockchain network.
 Handles peer registration, matchmaking, and exposes HTTP endpoints for
 per-peer chain data and match logs via Flask.
+
+All peer sockets are multiplexed on a single selector loop, so the number of
+connected peers is not limited by the number of threads the tracker can spawn.
+
+Several trackers can share one network as shards (see shard.py): each one
+owns the peers that hash to it, matches its own peers with each other and
+with peers other shards offer, and answers /chains and /logs for all shards.
 """
 
+import collections
+import logging
+import selectors
 import socket
 import threading
 import json
 import time
 import random
 
-from flask import Flask, jsonify
+import sqlite3
 
+import requests
+from flask import Flask, Response, jsonify, request
+
+import metrics
 from global_vars import TRACKER_PORT
+from matchlog import MatchLog
+from logconfig import setup_logging
+from shard import Broker, HashRing
+import profiling
+
+log = logging.getLogger(__name__)
 
 
 flask_app = Flask(__name__)
@@ -22,77 +42,510 @@ flask_app = Flask(__name__)
 @flask_app.route('/logs', methods=['GET'])
 def get_logs():
     """
-    HTTP endpoint to retrieve logs of completed matches.
+    HTTP endpoint to retrieve logs of completed matches, one page at a time.
+
+    When sharded, every shard's log is paged at once: the cursor is then a
+    comma-separated list of `shard_id=cursor` pairs, and each record says
+    which shard stored it.
+
+    Query params:
+        cursor (int or str): `next_cursor` from the previous page (default 0).
+        limit (int): Page size per shard, capped at 500 (default 100).
+        local (int): If 1, only this shard's log.
+
+    Returns:
+        JSON with `records`, `next_cursor` and `oldest` available seq.
+    """
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+    if tracker.broker is None or request.args.get('local', 0, type=int):
+        return jsonify(tracker.match_log.page(request.args.get('cursor', 0, type=int), limit))
+
+    cursor = request.args.get('cursor', '0')
+    if cursor.isdigit():
+        cursors = collections.defaultdict(lambda: int(cursor))
+    else:
+        cursors = collections.defaultdict(int, ((shard_id, int(seq)) for shard_id, seq in
+                                                (pair.rsplit('=', 1) for pair in cursor.split(',') if pair)))
+    pages = {tracker.shard_id: tracker.match_log.page(cursors[tracker.shard_id], limit)}
+    pages.update(tracker.fan_out('/logs', lambda shard_id: {'cursor': cursors[shard_id], 'limit': limit}))
+    records = sorted(({**record, 'shard': shard_id} for shard_id, page in pages.items()
+                      for record in page['records']), key=lambda record: record['ended_at'])
+    return jsonify({
+        'records': records,
+        'next_cursor': ','.join(f"{shard_id}={page['next_cursor']}" for shard_id, page in sorted(pages.items())),
+        'oldest': {shard_id: page['oldest'] for shard_id, page in pages.items()}
+    })
+
+@flask_app.route('/leaderboard', methods=['GET'])
+def get_leaderboard():
+    """
+    HTTP endpoint to retrieve the win/loss/tie standings.
+
+    Returns:
+        JSON list of {peer, wins, losses, ties}, best first, taken from the
+        longest chain any peer has reported.
+    """
+    return jsonify(tracker.leaderboard_snapshot())
+
+@flask_app.route('/queues', methods=['GET'])
+def get_queues():
+    """
+    HTTP endpoint to inspect the tracker's outbound send queues.
+
+    Returns:
+        JSON with tracker-wide send counters and per-peer queue depths.
+    """
+    return jsonify(tracker.queue_stats())
+
+@flask_app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    HTTP endpoint exposing tracker and aggregated peer metrics.
 
     Returns:
-        JSON list of match log strings.
+        Prometheus text exposition format.
     """
-    return jsonify(tracker.match_logs)
+    return Response(tracker.metrics_text(), mimetype='text/plain; version=0.0.4')
 
 @flask_app.route('/chains', methods=['GET'])
 def get_chains():
     """
     HTTP endpoint to retrieve each peer's local blockchain data.
 
+    When sharded, the chains reported to every shard are merged, unless
+    `local=1` is passed.
+
     Returns:
-        JSON mapping of peer_id to list of block JSON strings.
+        JSON mapping of peer_id to its newest block JSON strings, oldest first.
     """
-    return jsonify(tracker.per_peer_chains)
+    chains = tracker.chains_snapshot()
+    if tracker.broker is not None and not request.args.get('local', 0, type=int):
+        for shard_chains in tracker.fan_out('/chains', lambda shard_id: {}).values():
+            chains.update((int(peer_id), chain) for peer_id, chain in shard_chains.items())
+    return jsonify(chains)
+
+
+# Messages that are superseded by later ones and can be dropped under backpressure.
+# A peer that misses one detects the version gap and asks for a fresh snapshot.
+# Snapshots are never dropped: they are what closes the gap, and the peer only
+# asks for one once.
+DROPPABLE_MESSAGES = ('network_delta',)
+
+class PeerConnection:
+    """
+    Per-socket state owned by the tracker's event loop.
+
+    Outbound messages wait in a bounded queue until the socket is writable,
+    so a peer that stops reading can only ever cost `max_queue` messages.
+    """
+    def __init__(self, sock, address, max_queue=256):
+        """
+        Wrap an accepted, non-blocking socket.
+
+        Args:
+            sock (socket.socket): Connected peer socket.
+            address (tuple): (host, port) of the peer.
+            max_queue (int): Maximum number of queued outbound messages.
+        """
+        self.socket = sock
+        self.address = address
+        self.peer_id = None  # set once the init message has been received
+        self.closing = False  # close once the queue is flushed (after a redirect)
+        self.inbuf = b""
+        self.outbuf = bytearray()  # bytes currently being written
+        self.queue = collections.deque()  # (droppable, bytes) waiting to be written
+        self.max_queue = max_queue
+        self.sent = 0
+        self.dropped = 0
+
+    def enqueue(self, data, droppable):
+        """
+        Queue an encoded message, applying the overflow policy.
+
+        When the queue is full the oldest droppable message is discarded to
+        make room. If nothing can be dropped the message is refused.
+
+        Args:
+            data (bytes): Encoded, newline-terminated message.
+            droppable (bool): Whether the message may be dropped later.
+
+        Returns:
+            bool: False if the queue overflowed and the peer should be cut off.
+        """
+        if len(self.queue) >= self.max_queue:
+            victim = next((item for item in self.queue if item[0]), None)
+            if victim is not None:
+                self.queue.remove(victim)
+                self.dropped += 1
+            elif droppable:
+                self.dropped += 1
+                return True
+            else:
+                return False
+        self.queue.append((droppable, data))
+        return True
+
+    def pending(self):
+        """
+        Return True if there is anything left to write.
+        """
+        return bool(self.outbuf or self.queue)
+
+    def fill(self, limit=65536):
+        """
+        Move queued messages into the write buffer, up to roughly `limit` bytes.
+        """
+        while self.queue and len(self.outbuf) < limit:
+            self.outbuf += self.queue.popleft()[1]
+            self.sent += 1
 
 class Tracker:
     """
     Tracker coordinates peer connections, matchmaking, and
     collects chain updates and match results.
     """
-    def __init__(self, host='localhost', port=TRACKER_PORT):
+    def __init__(self, host='localhost', port=TRACKER_PORT, match_interval=10,
+                 roster_window=0.05, max_queue=256, log_capacity=1000, log_path=None,
+                 max_matches_per_peer=1, chain_window=50, broker=None, http_port=None, broker_interval=0.1):
         """
-        Initialize the tracker server state and start matchmaking thread.
+        Initialize the tracker server state.
 
         Args:
             host (str): Address to bind the TCP socket.
             port (int): Port to bind the TCP socket.
+            match_interval (float): Seconds between matchmaking rounds.
+            roster_window (float): Seconds to coalesce joins/leaves before
+                broadcasting a single network delta.
+            max_queue (int): Outbound queue capacity per peer connection.
+            log_capacity (int): Match records kept in memory.
+            log_path (str, optional): File that every match record is appended to.
+            max_matches_per_peer (int): Matches a peer may play at the same time.
+            chain_window (int): Newest blocks kept per peer for /chains.
+            broker (shard.Broker, optional): Shared state that makes this tracker
+                one shard of several. Without it the tracker runs alone.
+            http_port (int, optional): Port of this tracker's HTTP endpoints,
+                announced so other shards can fan /chains and /logs out to it.
+            broker_interval (float): Seconds between broker polls.
         """
         self.host = host
         self.port = port
+        self.match_interval = match_interval
+        self.roster_window = roster_window
+        self.max_queue = max_queue
+        self.max_matches_per_peer = max_matches_per_peer
+        self.chain_window = chain_window
         self.peers = {}
-        self.per_peer_chains = {} #Tracks each peers local blockchain
+        self.per_peer_chains = {} #Tracks the newest chain_window blocks of each peer
+        self.leaderboard = (-1, [])  # (height, standings) of the longest reported chain
+        self.peer_heights = {}  # peer_id -> last reported chain height
         self.next_peer_id = 1
         self.next_match_id = 1  # increment with each match
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.available_peers = []  # Peers not currently playing
-        self.match_logs = []  # Stores logs for completed matches between peers
+        self.available_peers = []  # Peers with at least one free match slot
+        self.match_counts = {}  # peer_id -> matches currently being played
+        self.match_log = MatchLog(log_capacity, log_path)  # Completed match records
+        self.active_matches = {}  # match_id -> peers and start time
+
+        # Roster as last broadcast to peers, plus the changes waiting for the
+        # next coalesced network_delta.
+        self.roster = {}
+        self.roster_version = 0
+        self._roster_joined = {}
+        self._roster_left = set()
+        self._roster_newcomers = set()
+        self._roster_flush_at = None
+
+        # Tracker metrics, plus the latest snapshot reported by each peer
+        self.metrics = metrics.Registry()
+        self.peer_metrics = {}
+        self.available_since = {}  # peer_id -> time it last became available
+        self._messages_sent = self.metrics.counter("rps_tracker_messages_sent_total",
+                                                   "Messages written to peer sockets")
+        self._messages_dropped = self.metrics.counter("rps_tracker_messages_dropped_total",
+                                                      "Roster updates dropped from full send queues")
+        self._overflow_disconnects = self.metrics.counter("rps_tracker_overflow_disconnects_total",
+                                                          "Peers disconnected for overflowing their send queue")
+        self._connections = self.metrics.gauge("rps_tracker_connections", "Open peer connections")
+        self._connections_total = self.metrics.counter("rps_tracker_connections_total", "Accepted peer connections")
+        self._matches_started = self.metrics.counter("rps_tracker_matches_started_total", "Matches started")
+        self._matchmaking_wait = self.metrics.histogram("rps_tracker_matchmaking_wait_seconds",
+                                                        "Time a peer waited in the available list before a match")
+
+        # Sharding: the broker, the ring of live shards, peers owned by other
+        # shards, and our peers currently offered to other shards
+        self.broker = broker
+        self.http_port = http_port
+        self.broker_interval = broker_interval
+        self.shard_id = f"{host}:{port}"
+        self.shards = {}
+        self.ring = HashRing([self.shard_id])
+        self.remote_peers = {}  # peer_id -> shard_id
+        self.lent = set()
+        self._event_cursor = 0
+        self._id_blocks = {}  # counter name -> [next id, end] reserved from the broker
+        self._spare_match_id = None
+        # writes waiting for the next broker sync, so the loop never waits on SQLite for them
+        self._broker_added = {}  # peer_id -> (address, port)
+        self._broker_removed = set()
+        self._broker_heights = {}
+        self._broker_events = []  # (kind, body, target)
 
-        # Start matchmaking loop to match peers and run games
-        self.matchmaking_thread = threading.Thread(target=self.matchmaking_loop)
-        self.matchmaking_thread.daemon = True
-        self.matchmaking_thread.start()
+        # Event loop state. Everything above is owned by the loop thread;
+        # state_lock only guards what the Flask threads read.
+        self.selector = selectors.DefaultSelector()
+        self.state_lock = profiling.instrument_lock(threading.Lock(), "rps_tracker_state_lock_wait_seconds",
+                                                    self.metrics, "Time spent waiting for Tracker.state_lock")
+        self.running = False
+        self.matchmaking_enabled = True  # cleared to let in-flight matches drain
+        self._calls = collections.deque()
+        self.accept_backoff = 1.0
+        self._accept_resume_at = None  # set while accepting is paused after an accept() error
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
 
-    def matchmaking_loop(self):
+    def chains_snapshot(self):
         """
-        Matchmaking loop to match peers and run games
+        Return a consistent copy of every peer's reported chain.
+
+        Safe to call from any thread (e.g. Flask request handlers).
         """
+        with self.state_lock:
+            return dict(self.per_peer_chains)
 
-        while True:
-            print(f"MATCHMAKING CHECK - Available peers: {self.available_peers}")
-            matches = []
-            random.shuffle(self.available_peers)
-            while len(self.available_peers) >= 2:
-                print(f"Found enough peers! Starting to match from: {self.available_peers}")
-                peer1_id = self.available_peers.pop(0)
-                peer2_id = self.available_peers.pop(0)
-
-                match_id = f"match_{self.next_match_id}"
-                self.next_match_id += 1
-                matches.append((peer1_id, peer2_id, match_id))
-
-            for peer1_id, peer2_id, match_id in matches:     
-                print(f"Creating match between peers {peer1_id} and {peer2_id} with id {match_id}")
-                t = threading.Thread(target=self.start_match,
-                    args=(peer1_id, peer2_id, match_id),
-                    daemon=True)
-                t.start()
-
-            time.sleep(10)
+    def leaderboard_snapshot(self):
+        """
+        Return the standings from the longest chain reported so far.
+
+        Safe to call from any thread (e.g. Flask request handlers).
+        """
+        return self.leaderboard[1]
+
+    def queue_stats(self):
+        """
+        Return send counters and the current queue depth of every peer.
+
+        Safe to call from any thread (e.g. Flask request handlers).
+        """
+        peers = {}
+        for peer_id, peer_data in list(self.peers.items()):
+            conn = peer_data['connection']
+            peers[peer_id] = {
+                'queued': len(conn.queue),
+                'sent': conn.sent,
+                'dropped': conn.dropped
+            }
+        return {
+            'messages_sent': self._messages_sent.value,
+            'messages_dropped': self._messages_dropped.value,
+            'overflow_disconnects': self._overflow_disconnects.value,
+            'max_queue': self.max_queue,
+            'peers': peers
+        }
+
+    def metrics_text(self):
+        """
+        Render tracker metrics and the sum of all peer reports for /metrics.
+
+        Safe to call from any thread (e.g. Flask request handlers).
+        """
+        peer_snapshots = list(self.peer_metrics.values())
+        self.metrics.gauge("rps_tracker_peers_reporting", "Peers whose metrics are aggregated below") \
+            .set(len(peer_snapshots))
+        return self.metrics.render() + metrics.render(metrics.merge(peer_snapshots))
+
+    def fan_out(self, path, params):
+        """
+        GET an HTTP endpoint on every other live shard.
+
+        Safe to call from any thread (e.g. Flask request handlers). Shards
+        that do not answer are left out of the result.
+
+        Args:
+            path (str): Endpoint path, e.g. "/chains".
+            params (callable): shard_id -> query parameters for that shard.
+
+        Returns:
+            dict: shard_id -> decoded JSON response.
+        """
+        results = {}
+        for shard_id, info in self.shards.items():
+            if shard_id == self.shard_id or info['http_port'] is None:
+                continue
+            try:
+                results[shard_id] = requests.get(f"http://{info['address']}:{info['http_port']}{path}",
+                                                 params={**params(shard_id), 'local': 1}, timeout=2).json()
+            except requests.RequestException as e:
+                log.warning("Fetching %s from shard %s failed: %s", path, shard_id, e)
+        return results
+
+    def call_soon(self, fn, *args):
+        """
+        Schedule fn(*args) to run on the event loop thread.
+
+        This is the only safe way for other threads to touch tracker state
+        or send to peers.
+        """
+        self._calls.append((fn, args))
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # a wakeup is already pending
+
+    def matchmake(self):
+        """
+        Pair up available peers and notify them that their match is starting.
+        """
+        if not self.matchmaking_enabled:
+            return
+        # opponents must know each other before they are paired
+        if self._roster_flush_at is not None:
+            self.broadcast_network_update()
+        if self.broker is not None:
+            try:
+                self._reclaim_offers()
+            except sqlite3.Error as e:
+                log.warning("Reclaiming offers failed: %s", e)
+        log.debug("MATCHMAKING CHECK - Available peers: %s", self.available_peers)
+        paired = {frozenset(match['peers']) for match in self.active_matches.values()}
+
+        # Each pass gives every peer with a free slot at most one new match,
+        # so peers allowed several matches are spread over several opponents
+        progress = True
+        while progress and len(self.available_peers) >= 2:
+            progress = False
+            waiting = collections.deque(random.sample(self.available_peers, len(self.available_peers)))
+            while len(waiting) >= 2:
+                peer1_id = waiting.popleft()
+                # never pair a peer with an opponent it is already playing
+                peer2_id = next((p for p in waiting if frozenset((peer1_id, p)) not in paired), None)
+                if peer2_id is None:
+                    continue
+                waiting.remove(peer2_id)
+                paired.add(frozenset((peer1_id, peer2_id)))
+                progress = True
+
+                now = time.monotonic()
+                for matched in (peer1_id, peer2_id):
+                    self._matchmaking_wait.observe(now - self.available_since.pop(matched, now))
+                self._matches_started.inc()
+
+                match_id = self._next_match_id()
+                log.info("Creating match between peers %s and %s with id %s", peer1_id, peer2_id, match_id)
+                self.start_match(peer1_id, peer2_id, match_id)
+
+        if self.broker is not None:
+            try:
+                self._match_across_shards()
+            except sqlite3.Error as e:
+                log.warning("Cross-shard matchmaking failed: %s", e)
+
+    def _next_match_id(self):
+        """
+        Return a new match id, unique across shards when sharded.
+        """
+        if self.broker is not None:
+            return f"match_{self._next_global_id('match')}"
+        match_id = f"match_{self.next_match_id}"
+        self.next_match_id += 1
+        return match_id
+
+    def _next_global_id(self, name, block=16):
+        """
+        Hand out the next id of a broker counter, reserving `block` ids at a time.
+        """
+        reserved = self._id_blocks.get(name)
+        if reserved is None or reserved[0] >= reserved[1]:
+            first = self.broker.allocate(name, block)
+            reserved = self._id_blocks[name] = [first, first + block]
+        reserved[0] += 1
+        return reserved[0] - 1
+
+    def _publish(self, kind, body, target=None):
+        """
+        Queue an event for other shards; it goes out with the next broker sync.
+        """
+        self._broker_events.append((kind, body, target))
+
+    def _reclaim_offers(self):
+        """
+        Take back offers no other shard claimed, so those peers can be matched here again.
+        """
+        for peer_id in self.broker.withdraw(self.shard_id):
+            self.lent.discard(peer_id)
+            if peer_id in self.peers and peer_id not in self.available_peers:
+                self.available_peers.append(peer_id)
+
+    def _match_across_shards(self):
+        """
+        Pair peers left over from local matchmaking with peers offered by
+        other shards, then offer whoever is still waiting.
+
+        An offered peer leaves available_peers until the offer is claimed
+        (the claiming shard sends us a match_start event) or reclaimed at
+        the start of the next round, so it is never double-booked. The
+        match_start event is written in the same transaction as the claim,
+        so an offer never disappears without one, even if we die right after.
+        """
+        for peer_id in list(self.available_peers):
+            opponents = {p for match in self.active_matches.values() if peer_id in match['peers']
+                         for p in match['peers']}
+            # an id drawn for a claim that found nobody is kept for the next one
+            match_id = self._spare_match_id or self._next_match_id()
+            started_at = time.time()
+            opponent = self.broker.claim(self.shard_id, opponents, {
+                'match_id': match_id,
+                'opponent_id': peer_id,
+                'opponent_addr': self.peers[peer_id]['address'][0],
+                'opponent_game_port': self.peers[peer_id]['game_port'],
+                'started_at': started_at
+            })
+            if opponent is None:
+                self._spare_match_id = match_id
+                break
+            self._spare_match_id = None
+            now = time.monotonic()
+            self._matchmaking_wait.observe(now - self.available_since.pop(peer_id, now))
+            self._matches_started.inc()
+            log.info("Creating match between peer %s and peer %s on shard %s with id %s",
+                     peer_id, opponent['peer_id'], opponent['shard_id'], match_id)
+            self.start_remote_match(peer_id, opponent, match_id, started_at)
+
+        if len(self.shards) < 2 or not self.available_peers:
+            return
+        # offers are ordered by how long the peer has waited, in wall-clock time
+        now, wall = time.monotonic(), time.time()
+        self.broker.offer(self.shard_id, [{
+            'peer_id': peer_id,
+            'address': self.peers[peer_id]['address'][0],
+            'port': self.peers[peer_id]['game_port'],
+            'since': wall - (now - self.available_since.get(peer_id, now))
+        } for peer_id in self.available_peers])
+        self.lent.update(self.available_peers)
+        self.available_peers = []
+
+    def _take_slot(self, peer_id):
+        """
+        Count one more match for a peer, removing it from matchmaking when it is full.
+        """
+        self.match_counts[peer_id] = self.match_counts.get(peer_id, 0) + 1
+        if self.match_counts[peer_id] >= self.max_matches_per_peer:
+            if peer_id in self.available_peers:
+                self.available_peers.remove(peer_id)
+        else:
+            self.available_since[peer_id] = time.monotonic()
+
+    def _free_slot(self, peer_id):
+        """
+        Count one less match for a peer, making it available again.
+        """
+        if peer_id not in self.peers:
+            return
+        self.match_counts[peer_id] = max(0, self.match_counts.get(peer_id, 0) - 1)
+        if peer_id not in self.available_peers and peer_id not in self.lent:
+            self.available_peers.append(peer_id)
+            self.available_since[peer_id] = time.monotonic()
+            log.debug("Peer %s is now available for new matches", peer_id)
 
     def start_match(self, peer1_id, peer2_id, match_id):
         """
@@ -107,6 +560,14 @@ class Tracker:
         """
         peer1_data = self.peers[peer1_id]
         peer2_data = self.peers[peer2_id]
+        self.active_matches[match_id] = {
+            'peers': [peer1_id, peer2_id],
+            'local': [peer1_id, peer2_id],
+            'started_at': time.time(),
+            'reported': set()
+        }
+        self._take_slot(peer1_id)
+        self._take_slot(peer2_id)
 
         self.send_to_peer(peer1_id, {
             'type': 'match_start',
@@ -124,98 +585,239 @@ class Tracker:
             'opponent_game_port': peer1_data['game_port']
         })
 
+    def start_remote_match(self, peer_id, opponent, match_id, started_at):
+        """
+        Start a match between one of our peers and a peer on another shard.
+
+        Our peer gets its `match_start` directly; the opponent's shard already
+        has its `match_start` event, written by the broker with the claim.
+
+        Args:
+            peer_id (int): Our peer's ID.
+            opponent (dict): Claimed offer with peer_id, shard_id, address and port.
+            match_id (str): Unique match identifier.
+            started_at (float): Wall-clock start time sent to the other shard.
+        """
+        self.active_matches[match_id] = {
+            'peers': [peer_id, opponent['peer_id']],
+            'local': [peer_id],
+            'started_at': started_at,
+            'reported': set()
+        }
+        self._take_slot(peer_id)
+
+        self.send_to_peer(peer_id, {
+            'type': 'match_start',
+            'match_id': match_id,
+            'opponent_id': opponent['peer_id'],
+            'opponent_addr': opponent['address'],
+            'opponent_game_port': opponent['port']
+        })
+
+    def _accept_remote_match(self, event):
+        """
+        Start our side of a match another shard created with one of our offered peers.
+        """
+        peer_id = event['peer_id']
+        self.lent.discard(peer_id)
+        if peer_id not in self.peers:
+            return  # gone; the other shard frees its peer when it sees our "left" event
+        self.active_matches[event['match_id']] = {
+            'peers': [peer_id, event['opponent_id']],
+            'local': [peer_id],
+            'started_at': event['started_at'],
+            'reported': set()
+        }
+        now = time.monotonic()
+        self._matchmaking_wait.observe(now - self.available_since.pop(peer_id, now))
+        if peer_id not in self.available_peers:
+            self.available_peers.append(peer_id)
+        self._take_slot(peer_id)
+
+        self.send_to_peer(peer_id, {
+            'type': 'match_start',
+            'match_id': event['match_id'],
+            'opponent_id': event['opponent_id'],
+            'opponent_addr': event['opponent_addr'],
+            'opponent_game_port': event['opponent_game_port']
+        })
+
     def send_to_peer(self, peer_id, message):
         """
-        Send a JSON message to a given peer over its tracking socket.
+        Queue a JSON message for a given peer over its tracking socket.
+
+        The bytes are written by the event loop once the socket is writable,
+        so this never blocks. Roster updates are dropped (oldest first) when
+        the peer's queue is full; any other message overflowing the queue
+        disconnects the peer. Must be called on the loop thread.
 
         Args:
             peer_id (int): ID of the recipient peer.
             message (dict): JSON-serializable message.
         """
-        self.peers[peer_id]['socket'].sendall(json.dumps(message).encode() + b'\n')
-        print(f"Message sent to peer {peer_id}")
+        if peer_id not in self.peers:
+            return
+        self._queue(self.peers[peer_id]['connection'], message)
+        log.debug("Message queued for peer %s", peer_id)
 
-    def broadcast_network_update(self):
+    def roster_snapshot(self):
         """
-        Broadcast a network update to all peers (i.e. new peer connections added/removed)
+        Build a full `network_update` message for the current roster version.
         """
-        if not self.peers:
-            return
+        return {
+            'type': 'network_update',
+            'version': self.roster_version,
+            'peers': self.roster
+        }
+
+    def _roster_changed(self, peer_id, joined, info=None):
+        """
+        Record a join or leave and schedule the next coalesced broadcast.
 
-        network_state = {}
-        for peer_id, peer_data in self.peers.items():
-            network_state[peer_id] = {
+        Args:
+            peer_id (int): Peer that joined or left.
+            joined (bool): True for a join, False for a leave.
+            info (dict, optional): Address and port of a peer that joined
+                another shard; our own peers are looked up in self.peers.
+        """
+        if joined and info is not None:
+            self._roster_joined[peer_id] = info
+        elif joined:
+            peer_data = self.peers[peer_id]
+            self._roster_joined[peer_id] = {
                 'address': peer_data['address'][0],
                 'port': peer_data['game_port'],
             }
+            self._roster_newcomers.add(peer_id)
+        elif peer_id in self._roster_joined:
+            # joined and left inside the same window: nobody needs to hear about it
+            del self._roster_joined[peer_id]
+            self._roster_newcomers.discard(peer_id)
+        else:
+            self._roster_left.add(peer_id)
 
-        message = {
-            'type': 'network_update',
-            'peers': network_state
+        if self._roster_flush_at is None:
+            self._roster_flush_at = time.monotonic() + self.roster_window
+
+    def broadcast_network_update(self):
+        """
+        Broadcast the joins/leaves collected since the last update as one delta.
+
+        Existing peers get a `network_delta` moving them from the previous
+        roster version to the new one; peers that joined in this window get a
+        full `network_update` snapshot instead.
+        """
+        self._roster_flush_at = None
+        if not self._roster_joined and not self._roster_left:
+            return
+
+        delta = {
+            'type': 'network_delta',
+            'base_version': self.roster_version,
+            'version': self.roster_version + 1,
+            'joined': self._roster_joined,
+            'left': sorted(self._roster_left)
         }
+        self.roster_version += 1
+        for peer_id in self._roster_left:
+            self.roster.pop(peer_id, None)
+        self.roster.update(self._roster_joined)
 
-        for peer_id in self.peers:
-            self.send_to_peer(peer_id, message)
+        snapshot = self.roster_snapshot()
+        for peer_id in list(self.peers):
+            self.send_to_peer(peer_id, snapshot if peer_id in self._roster_newcomers else delta)
 
-    def handle_new_peer(self, client_socket, address):
+        self._roster_joined = {}
+        self._roster_left = set()
+        self._roster_newcomers = set()
+
+    def handle_new_peer(self, conn, init_message):
         """
-        Register a new peer connection and listen for its messages.
+        Register a new peer once its init message has arrived.
 
         Args:
-            client_sock (socket.socket): Connected socket.
-            addr (tuple): (host, port) of the peer.
+            conn (PeerConnection): Connection the init message came from.
+            init_message (dict): Parsed init message.
         """
-
-        peer_id = self.next_peer_id
-        self.next_peer_id += 1
-
-        data = client_socket.recv(1024).decode()
-        init_message = json.loads(data)
-        game_port = init_message['game_port']
+        if self.broker is not None:
+            # ids are global; a peer redirected here already carries its id,
+            # but never let a client take over the id of a connected peer
+            peer_id = init_message.get('peer_id')
+            if not isinstance(peer_id, int) or peer_id in self.peers or peer_id in self.remote_peers:
+                peer_id = self._next_global_id('peer')
+            owner = self.ring.owner(peer_id)
+            if owner != self.shard_id and owner in self.shards:
+                log.info("Redirecting peer %s to shard %s", peer_id, owner)
+                conn.closing = True
+                self._queue(conn, {
+                    'type': 'redirect',
+                    'peer_id': peer_id,
+                    'address': self.shards[owner]['address'],
+                    'port': self.shards[owner]['port']
+                })
+                return
+        else:
+            peer_id = self.next_peer_id
+            self.next_peer_id += 1
+        conn.peer_id = peer_id
 
         # add new peer to peers dict
         self.peers[peer_id] = {
-            'address': address,
-            'socket': client_socket,
-            'game_port': game_port
+            'address': conn.address,
+            'socket': conn.socket,
+            'connection': conn,
+            'game_port': init_message['game_port']
         }
 
-        response = {
+        self.send_to_peer(peer_id, {
             'type': 'peer_id',
             'peer_id': peer_id
-        }
+        })
 
-        client_socket.send(json.dumps(response).encode() + b'\n')
+        # where to download the chain from if the network is already running
+        self.send_to_peer(peer_id, self.sync_info(peer_id))
 
         self.available_peers.append(peer_id)
-        print(f"Added peer {peer_id} to available_peers list. Current available: {self.available_peers}")
+        self.available_since[peer_id] = time.monotonic()
+        self.match_counts[peer_id] = 0
+        log.info("Added peer %s to available_peers list", peer_id)
 
-        self.broadcast_network_update()
+        self._roster_changed(peer_id, joined=True)
+        if self.broker is not None:
+            address, port = conn.address[0], init_message['game_port']
+            self._broker_added[peer_id] = (address, port)
+            self._publish('joined', {'peer_id': peer_id, 'address': address, 'port': port})
 
-        buffer = ""
-        try:
-            while True:
-                chunk = client_socket.recv(1024).decode()
-                if not chunk:
-                    break
-                buffer += chunk
+    def sync_info(self, peer_id, limit=8):
+        """
+        Build the sync_info message a joining peer bootstraps from.
 
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    if line.strip():  # avoid empty lines
-                        message = json.loads(line)
-                        self.handle_peer_message(peer_id, message)
+        Args:
+            peer_id (int): The joining peer, left out of the sources.
+            limit (int): Most sources to offer.
 
-        except Exception as e:
-            print(f"Error handling peer {peer_id}: {e}")
-        finally:
-            if peer_id in self.peers:
-                del self.peers[peer_id]
-            if peer_id in self.available_peers:
-                self.available_peers.remove(peer_id)
-            client_socket.close()
-            print(f"Peer {peer_id} disconnected")
-            self.broadcast_network_update()
+        When sharded, peers of every shard are candidates.
+
+        Returns:
+            dict: Best reported height and the highest peers to download from.
+        """
+        if self.broker is not None:
+            # our own peers' heights may not have been synced to the broker yet
+            candidates = [{'peer_id': p['peer_id'], 'address': p['address'], 'port': p['port'],
+                           'height': self.peer_heights.get(p['peer_id'], p['height'])}
+                          for p in self.broker.peers()]
+            candidates = [p for p in candidates if p['height'] is not None]
+        else:
+            candidates = [{'peer_id': pid,
+                           'address': self.peers[pid]['address'][0],
+                           'port': self.peers[pid]['game_port'],
+                           'height': height} for pid, height in self.peer_heights.items() if pid in self.peers]
+        sources = sorted((p for p in candidates if p['peer_id'] != peer_id), key=lambda p: -p['height'])
+        return {
+            'type': 'sync_info',
+            'height': max((p['height'] for p in candidates), default=0),
+            'peers': sources[:limit]
+        }
 
     def handle_peer_message(self, peer_id, message):
         """
@@ -227,47 +829,372 @@ class Tracker:
         """
         # Store the local blockchain from a peer
         if message['type'] == 'blockchain_update':
-            print(f"Got local blockchain from peer {peer_id}")
-            self.per_peer_chains[message['peer_id']] = message['local_blockchain']
+            log.debug("Got local blockchain from peer %s", peer_id)
+            with self.state_lock:
+                self.per_peer_chains[message['peer_id']] = message['local_blockchain'][-self.chain_window:]
+            self.peer_heights[peer_id] = message['height']
+            if self.broker is not None:
+                self._broker_heights[peer_id] = message['height']
+            if message['height'] >= self.leaderboard[0]:
+                self.leaderboard = (message['height'], message['leaderboard'])
+
+        if message['type'] == 'metrics_report':
+            self.peer_metrics[peer_id] = message['metrics']
+
+        if message['type'] == 'roster_request':
+            # peer missed a delta; resync it with a full snapshot
+            self.send_to_peer(peer_id, self.roster_snapshot())
 
         if message['type'] == 'game_end':
-            # Add peer back to 'available' list
             peer_id = message['peer_id']
-            if peer_id not in self.available_peers:
-                self.available_peers.append(peer_id)
-                print(f"Peer {peer_id} is now available for new matches")
-                print(f"Current available peers: {self.available_peers}")
+            match_id = message['match_id']
+            match = self.active_matches.get(match_id)
+
+            # Give the peer its match slot back (once per match)
+            if match is not None and peer_id in match['peers'] and peer_id not in match['reported']:
+                self._free_slot(peer_id)
+
+            # Store the match record
+            record = self.match_log.append({
+                'match_id': match_id,
+                'peers': [peer_id, message['opponent_id']],
+                'reporter': peer_id,
+                'result': message['result'],
+                'started_at': match['started_at'] if match else None,
+                'ended_at': message['ended_at']
+            })
+            log.info("match record %s stored: %s -> peer %s %s", record['seq'], match_id, peer_id, message['result'])
+
+            if match is not None:
+                match['reported'].add(peer_id)
+                # only this shard's peers report to us
+                if match['reported'] >= set(match['local']):
+                    del self.active_matches[match_id]
+
+    def _queue(self, conn, message):
+        """
+        Enqueue a message on a connection and watch for writability.
+        """
+        was_idle = not conn.pending()
+        dropped = conn.dropped
+        if not conn.enqueue(json.dumps(message).encode() + b'\n',
+                            message['type'] in DROPPABLE_MESSAGES):
+            log.warning("Send queue overflow for peer %s, disconnecting", conn.peer_id)
+            self._overflow_disconnects.inc()
+            self._disconnect(conn)
+            return
+        self._messages_dropped.inc(conn.dropped - dropped)
+        if was_idle:
+            self._watch(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def _watch(self, conn, events):
+        """
+        Register (or re-register) a connection with the selector for the given events.
+        """
+        callback = lambda mask: self._service(conn, mask)
+        try:
+            self.selector.modify(conn.socket, events, callback)
+        except KeyError:
+            self.selector.register(conn.socket, events, callback)
+
+    def _accept(self, mask):
+        """
+        Accept every pending connection on the listening socket.
+        """
+        while True:
+            try:
+                client_socket, address = self.socket.accept()
+            except BlockingIOError:
+                return
+            except ConnectionAbortedError:
+                continue  # the client gave up before we got to it
+            except OSError as e:
+                # usually EMFILE: stop accepting for a while instead of spinning on the readable socket
+                log.warning("accept() failed, pausing new connections for %ss: %s", self.accept_backoff, e)
+                self.selector.unregister(self.socket)
+                self._accept_resume_at = time.monotonic() + self.accept_backoff
+                return
+            log.debug("New connection from %s", address)
+            client_socket.setblocking(False)
+            conn = PeerConnection(client_socket, address, self.max_queue)
+            self._connections.inc()
+            self._connections_total.inc()
+            self._watch(conn, selectors.EVENT_READ)
+
+    def _service(self, conn, mask):
+        """
+        Handle a readiness event for one peer connection.
+        """
+        try:
+            if mask & selectors.EVENT_WRITE and conn.pending():
+                sent_before = conn.sent
+                conn.fill()
+                self._messages_sent.inc(conn.sent - sent_before)
+                sent = conn.socket.send(conn.outbuf)
+                del conn.outbuf[:sent]
+                if not conn.pending():
+                    if conn.closing:
+                        self._disconnect(conn)
+                        return
+                    self._watch(conn, selectors.EVENT_READ)
+
+            if mask & selectors.EVENT_READ:
+                chunk = conn.socket.recv(4096)
+                if not chunk:
+                    self._disconnect(conn)
+                    return
+                conn.inbuf += chunk
+
+                while b"\n" in conn.inbuf:
+                    line, conn.inbuf = conn.inbuf.split(b"\n", 1)
+                    if not line.strip():  # avoid empty lines
+                        continue
+                    message = json.loads(line)
+                    if conn.peer_id is None:
+                        self.handle_new_peer(conn, message)
+                    else:
+                        self.handle_peer_message(conn.peer_id, message)
+                    if conn.socket.fileno() == -1:
+                        return  # disconnected while handling
+        except (BlockingIOError, InterruptedError):
+            pass
+        except Exception as e:
+            log.warning("Error handling peer %s: %s", conn.peer_id, e)
+            self._disconnect(conn)
 
-            # Store the match log
-            self.match_logs.append(message['match_log'])
-            print(f'match log appended')
-            print(self.match_logs)
+    def _disconnect(self, conn):
+        """
+        Tear down a peer connection and tell the rest of the network.
+        """
+        try:
+            self.selector.unregister(conn.socket)
+        except (KeyError, ValueError):
+            return  # already gone
+        conn.socket.close()
+        self._connections.dec()
+
+        peer_id = conn.peer_id
+        if peer_id is None:
+            return
+        if peer_id in self.peers:
+            del self.peers[peer_id]
+        if peer_id in self.available_peers:
+            self.available_peers.remove(peer_id)
+        self.available_since.pop(peer_id, None)
+        self.match_counts.pop(peer_id, None)
+        self.peer_heights.pop(peer_id, None)
+        self.peer_metrics.pop(peer_id, None)
+        with self.state_lock:
+            self.per_peer_chains.pop(peer_id, None)
+        self.lent.discard(peer_id)
+        self._drop_matches(peer_id)
+        log.info("Peer %s disconnected", peer_id)
+        self._roster_changed(peer_id, joined=False)
+        if self.broker is not None:
+            self._broker_removed.add(peer_id)
+            self._broker_heights.pop(peer_id, None)
+            self._publish('left', {'peer_id': peer_id})
+
+    def _drop_matches(self, peer_id):
+        """
+        Forget the active matches of a peer that left.
+        """
+        for match_id in [m for m, match in self.active_matches.items() if peer_id in match['peers']]:
+            # the opponent will never hear back, so free its slot now
+            for other in self.active_matches.pop(match_id)['peers']:
+                if other != peer_id:
+                    self._free_slot(other)
+
+    def _join_shards(self):
+        """
+        Register with the broker and load the peers other shards already have.
+        """
+        self.broker.unregister(self.shard_id)  # leftovers from an earlier run on this address
+        self.broker.register(self.shard_id, self.host, self.port, self.http_port)
+        # read the cursor first: a peer joining in between is then seen twice, never missed
+        self._event_cursor = self.broker.last_event()
+        for peer in self.broker.peers():
+            self.remote_peers[peer['peer_id']] = peer['shard_id']
+            self._roster_changed(peer['peer_id'], True, {'address': peer['address'], 'port': peer['port']})
+        self.shards = self.broker.live_shards()
+        self.ring = HashRing(self.shards)
+        log.info("Joined as shard %s alongside %s", self.shard_id, sorted(set(self.shards) - {self.shard_id}))
+
+    def _poll_broker(self):
+        """
+        Sync our batched writes (doubling as a heartbeat), follow shards
+        coming and going, and apply other shards' events.
+
+        Broker errors are logged and the writes are kept for the next poll.
+        """
+        added = [(peer_id, *info) for peer_id, info in self._broker_added.items()]
+        removed, heights, events = set(self._broker_removed), dict(self._broker_heights), list(self._broker_events)
+        try:
+            rejoined = self.broker.sync(self.shard_id, self.host, self.port, self.http_port,
+                                        added, removed, heights, events)
+            shards = self.broker.live_shards()
+            new_events = self.broker.events(self.shard_id, self._event_cursor)
+        except sqlite3.Error as e:
+            log.warning("Broker sync failed, retrying next poll: %s", e)
+            return
+        self._broker_added.clear()
+        self._broker_removed -= removed
+        for peer_id, height in heights.items():
+            if self._broker_heights.get(peer_id) == height:
+                del self._broker_heights[peer_id]
+        del self._broker_events[:len(events)]
+        if rejoined:
+            # other shards gave us up for dead and dropped our peers; announce them again
+            log.warning("Shard %s was dropped from the broker, republishing %s peers", self.shard_id, len(self.peers))
+            for peer_id, peer_data in self.peers.items():
+                address, port = peer_data['address'][0], peer_data['game_port']
+                self._broker_added[peer_id] = (address, port)
+                self._publish('joined', {'peer_id': peer_id, 'address': address, 'port': port})
+                if peer_id in self.peer_heights:
+                    self._broker_heights[peer_id] = self.peer_heights[peer_id]
+            # our offers were deleted with us, so nobody will claim them now
+            for peer_id in self.lent:
+                if peer_id in self.peers and peer_id not in self.available_peers:
+                    self.available_peers.append(peer_id)
+            self.lent.clear()
+
+        if set(shards) != set(self.shards):
+            log.info("Shards changed: %s", sorted(shards))
+            self.ring = HashRing(shards)
+            for peer_id, shard_id in list(self.remote_peers.items()):
+                if shard_id not in shards:
+                    self._remote_left(peer_id)
+        self.shards = shards
+
+        for seq, origin, kind, body in new_events:
+            self._event_cursor = seq
+            if kind == 'joined':
+                self.remote_peers[body['peer_id']] = origin
+                self._roster_changed(body['peer_id'], True, {'address': body['address'], 'port': body['port']})
+            elif kind == 'left':
+                self._remote_left(body['peer_id'])
+            elif kind == 'match_start':
+                self._accept_remote_match(body)
+
+    def _remote_left(self, peer_id):
+        """
+        Drop a peer of another shard that disconnected, or whose shard died.
+        """
+        if self.remote_peers.pop(peer_id, None) is None:
+            return
+        self._drop_matches(peer_id)
+        self._roster_changed(peer_id, joined=False)
+
+    def _drain_wakeup(self, mask):
+        """
+        Clear pending wakeup bytes written by call_soon().
+        """
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
 
     def start(self):
         """
-        Start the TCP server to accept new peer connections.
+        Start the TCP server and run the event loop until stop() is called.
+
+        Accepting, reading, writing and matchmaking all happen on this thread.
         """
 
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.host, self.port))
-        self.socket.listen()
-        print(f"Tracker is listening on {self.host}:{self.port}")
+        self.socket.listen(1024)
+        self.socket.setblocking(False)
+        log.info("Tracker is listening on %s:%s", self.host, self.port)
 
-        while True:
-            client_socket, address = self.socket.accept()
-            print(f"New connection from {address}")
+        self.selector.register(self.socket, selectors.EVENT_READ, self._accept)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, self._drain_wakeup)
+        if self.broker is not None:
+            self._join_shards()
+
+        self.running = True
+        next_match = time.monotonic() + self.match_interval
+        next_poll = time.monotonic()
+        while self.running:
+            deadline = next_match
+            if self._roster_flush_at is not None:
+                deadline = min(deadline, self._roster_flush_at)
+            if self.broker is not None:
+                deadline = min(deadline, next_poll)
+            if self._accept_resume_at is not None:
+                deadline = min(deadline, self._accept_resume_at)
+            timeout = max(0.0, deadline - time.monotonic())
+            for key, mask in self.selector.select(timeout):
+                self._guarded(key.data, mask)
 
-            # Create a new thread for each peer
-            client_thread = threading.Thread(
-                target=self.handle_new_peer,
-                args=(client_socket, address)
-            )
-            client_thread.start()
+            while self._calls:
+                fn, args = self._calls.popleft()
+                self._guarded(fn, *args)
+
+            if self._accept_resume_at is not None and time.monotonic() >= self._accept_resume_at:
+                self._accept_resume_at = None
+                self.selector.register(self.socket, selectors.EVENT_READ, self._accept)
+
+            if self.broker is not None and time.monotonic() >= next_poll:
+                self._poll_broker()
+                next_poll = time.monotonic() + self.broker_interval
+
+            if self._roster_flush_at is not None and time.monotonic() >= self._roster_flush_at:
+                self._guarded(self.broadcast_network_update)
+
+            if time.monotonic() >= next_match:
+                self._guarded(self.matchmake)
+                next_match = time.monotonic() + self.match_interval
+
+        if self.broker is not None:
+            try:
+                self.broker.unregister(self.shard_id)
+            except sqlite3.Error as e:
+                log.warning("Unregistering shard %s failed: %s", self.shard_id, e)
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+    def _guarded(self, fn, *args):
+        """
+        Run one loop callback, logging instead of letting an exception end the loop.
+        """
+        try:
+            fn(*args)
+        except Exception:
+            log.exception("Tracker loop callback %s failed", getattr(fn, "__name__", fn))
+
+    def stop(self):
+        """
+        Ask the event loop to exit and close every socket.
+        """
+        def _stop():
+            self.running = False
+        self.call_soon(_stop)
 
 
 if __name__ == "__main__":
-    tracker = Tracker()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="RPS blockchain tracker")
+    parser.add_argument("--log-level", help="DEBUG, INFO, WARNING... (default: $RPS_LOG_LEVEL or INFO)")
+    parser.add_argument("--profile", metavar="DIR", help="write cProfile/tracemalloc/lock-wait dumps to DIR "
+                                                         "(default: $RPS_PROFILE, off if unset)")
+    parser.add_argument("--profile-interval", type=float, help="seconds between profile dumps (default: 30)")
+    parser.add_argument("--max-matches", type=int, default=1, help="matches a peer may play at once (default: 1)")
+    parser.add_argument("--port", type=int, default=TRACKER_PORT, help=f"peer port (default: {TRACKER_PORT})")
+    parser.add_argument("--http-port", type=int, default=9000, help="HTTP endpoint port (default: 9000)")
+    parser.add_argument("--broker", metavar="PATH", help="SQLite file shared with other tracker shards "
+                                                         "(default: run alone)")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    profiling.enable(args.profile, f"tracker-{args.port}", args.profile_interval)
+
+    tracker = Tracker(port=args.port, max_matches_per_peer=args.max_matches, http_port=args.http_port,
+                      broker=Broker(args.broker) if args.broker else None)
     # Prevents blocking behavior
     threading.Thread(target=tracker.start, daemon=True).start()
 
     # So we can host the endpoint
-    flask_app.run(port=9000)
+    flask_app.run(port=args.http_port)